@@ -121,10 +121,15 @@ namespace BaseballApi.Controllers
             }
 
             var allResults = sortedResources
-                .Select(r => r.Files.First(f =>
-                    f.Purpose == RemoteFilePurpose.Thumbnail
-                    && f.NameModifier != null
-                    && f.NameModifier == size))
+                .Select(r => r.Files
+                    .Where(f =>
+                        f.Purpose == RemoteFilePurpose.Thumbnail
+                        && f.NameModifier != null
+                        && f.NameModifier == size)
+                    // a size may be stored in several formats; serve the smallest, falling back to JPEG
+                    .OrderBy(f => f.Extension == ".avif" ? 0 : f.Extension == ".webp" ? 1 : f.Extension == ".jpeg" ? 2 : 3)
+                    .ThenBy(f => f.Extension)
+                    .First())
                 .Select(f => new RemoteFileDetail
                 {
                     AssetIdentifier = f.Resource.AssetIdentifier,
@@ -148,8 +153,12 @@ namespace BaseballApi.Controllers
         {
             return await _context.MediaResources
                 .Where(r => r.AssetIdentifier == assetIdentifier)
-                .Select(r => r.Files.First(f =>
-                    f.Purpose == RemoteFilePurpose.Thumbnail && f.NameModifier != null && f.NameModifier == size))
+                .Select(r => r.Files
+                    .Where(f =>
+                        f.Purpose == RemoteFilePurpose.Thumbnail && f.NameModifier != null && f.NameModifier == size)
+                    .OrderBy(f => f.Extension == ".avif" ? 0 : f.Extension == ".webp" ? 1 : f.Extension == ".jpeg" ? 2 : 3)
+                    .ThenBy(f => f.Extension)
+                    .First())
                 .Select(f => new RemoteFileDetail
                 {
                     AssetIdentifier = f.Resource.AssetIdentifier,
@@ -186,10 +195,14 @@ namespace BaseballApi.Controllers
             }
 
             var allResults = query.OrderBy(r => Guid.NewGuid())
-                .Select(r => r.Files.First(f =>
-                    f.Purpose == RemoteFilePurpose.Thumbnail
-                    && f.NameModifier != null
-                    && f.NameModifier == size))
+                .Select(r => r.Files
+                    .Where(f =>
+                        f.Purpose == RemoteFilePurpose.Thumbnail
+                        && f.NameModifier != null
+                        && f.NameModifier == size)
+                    .OrderBy(f => f.Extension == ".avif" ? 0 : f.Extension == ".webp" ? 1 : f.Extension == ".jpeg" ? 2 : 3)
+                    .ThenBy(f => f.Extension)
+                    .First())
                 .Select(f => new RemoteFileDetail
                 {
                     AssetIdentifier = f.Resource.AssetIdentifier,
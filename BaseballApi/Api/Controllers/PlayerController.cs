@@ -107,10 +107,15 @@ namespace BaseballApi.Controllers
             }
 
             var size = "large";
-            summary.Photo = player.Media.Select(r => r.Files.First(f =>
+            summary.Photo = player.Media.Select(r => r.Files
+                .Where(f =>
                     f.Purpose == RemoteFilePurpose.Thumbnail
                     && f.NameModifier != null
-                    && f.NameModifier == size))
+                    && f.NameModifier == size)
+                // a size may be stored in several formats; serve the smallest, falling back to JPEG
+                .OrderBy(f => f.Extension == ".avif" ? 0 : f.Extension == ".webp" ? 1 : f.Extension == ".jpeg" ? 2 : 3)
+                .ThenBy(f => f.Extension)
+                .First())
                 .Select(f => new RemoteFileDetail
                 {
                     AssetIdentifier = f.Resource.AssetIdentifier,
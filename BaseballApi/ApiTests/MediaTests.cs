@@ -83,6 +83,51 @@ public class MediaTests : BaseballTests, IAsyncLifetime
         });
     }
 
+    [Fact]
+    public async Task TestGetThumbnailFormatPreference()
+    {
+        var resource = new MediaResource
+        {
+            AssetIdentifier = Guid.NewGuid(),
+            DateTime = DateTimeOffset.UtcNow,
+            OriginalFileName = "IMG_0001.HEIC",
+            ResourceType = MediaResourceType.Photo
+        };
+        foreach (var extension in new[] { ".jpeg", ".webp", ".avif" })
+        {
+            resource.Files.Add(new RemoteFile
+            {
+                Resource = resource,
+                Purpose = RemoteFilePurpose.Thumbnail,
+                NameModifier = "small",
+                Extension = extension
+            });
+        }
+        resource.Files.Add(new RemoteFile { Resource = resource, Purpose = RemoteFilePurpose.Original, Extension = ".heic" });
+        Context.MediaResources.Add(resource);
+        await Context.SaveChangesAsync();
+
+        try
+        {
+            foreach (var expected in new[] { ".avif", ".webp", ".jpeg" })
+            {
+                var thumbnail = await Controller.GetThumbnail(resource.AssetIdentifier, "small");
+                Assert.NotNull(thumbnail.Value);
+                Assert.Equal(expected, thumbnail.Value.Value.Extension);
+                Assert.Equal($"{resource.AssetIdentifier.ToString("D").ToUpper()}/thumbnail_small{expected}", thumbnail.Value.Value.Key);
+
+                // without the served format, the next one down is used
+                resource.Files.Remove(resource.Files.Single(f => f.Purpose == RemoteFilePurpose.Thumbnail && f.Extension == expected));
+                await Context.SaveChangesAsync();
+            }
+        }
+        finally
+        {
+            Context.MediaResources.Remove(resource);
+            await Context.SaveChangesAsync();
+        }
+    }
+
     [Fact]
     [Trait(TestCategory.Category, TestCategory.Media)]
     public async Task TestImportLivePhotos()
@@ -0,0 +1,545 @@
+import argparse
+import boto3
+import json
+import os
+import platform
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from PIL import Image
+import psycopg
+
+from bucket_connect import BucketConnector
+from db_connect import DbConnector
+from file_manifest import FileManifest
+from metrics import Metrics
+from path_management import Game, PathManager
+from photo_export import PhotoExporter
+from thumbnails import WEB_FORMATS, ThumbnailDef, ThumbnailParams, Thumbnailer, with_formats
+
+# optional: psutil samples the RSS of the pool workers too, moto provides the S3 emulator
+try:
+    import psutil
+except ImportError:
+    psutil = None
+try:
+    from moto.server import ThreadedMotoServer
+except ImportError:
+    ThreadedMotoServer = None
+
+SIZES = [ThumbnailDef(120, 'small'), ThumbnailDef(400, 'medium'), ThumbnailDef(1600, 'large')]
+
+# the parts of the API's schema the importer reads and writes
+SCHEMA = """
+    CREATE TABLE "Games" (
+        "Id" bigint GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+        "Name" text NOT NULL,
+        "Date" date NOT NULL,
+        "ScheduledTime" timestamp with time zone,
+        "StartTime" timestamp with time zone,
+        "EndTime" timestamp with time zone,
+        "ScorecardId" bigint
+    );
+    CREATE TABLE "RemoteResource" (
+        "Id" bigint GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+        "AssetIdentifier" uuid NOT NULL UNIQUE,
+        "DateTime" timestamp with time zone NOT NULL,
+        "OriginalFileName" text NOT NULL,
+        "GameId" bigint,
+        "Discriminator" character varying(21) NOT NULL,
+        "ResourceType" integer,
+        "Favorite" boolean,
+        "AlternateFormatOverride" boolean
+    );
+    CREATE INDEX ON "RemoteResource" ("GameId");
+    CREATE TABLE "RemoteFile" (
+        "Id" bigint GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+        "ResourceId" bigint NOT NULL REFERENCES "RemoteResource" ON DELETE CASCADE,
+        "Purpose" integer NOT NULL,
+        "NameModifier" text,
+        "Extension" text NOT NULL,
+        "ContentType" text
+    );
+    CREATE UNIQUE INDEX ON "RemoteFile" ("ResourceId", "NameModifier", "Extension");
+"""
+
+class SyntheticPhoto:
+    # stands in for osxphotos.PhotoInfo, exporting by hardlink
+
+    def __init__(self, source: str, date: datetime, favorite: bool = False):
+        self.uuid = str(uuid.uuid4()).upper()
+        self.date = date
+        self.ismovie = source.endswith('.mov')
+        self.isphoto = not self.ismovie
+        self.ismissing = False
+        self.hasadjustments = False
+        self.live_photo = False
+        self.date_modified = None
+        self.favorite = favorite
+        self.original_filename = os.path.basename(source)
+        self.filename = f'{self.uuid}{os.path.splitext(source)[1]}'
+        self.source = source
+
+    def export(self, dest: str, filename: str | None = None, edited: bool = False, live_photo: bool = False,
+               export_as_hardlink: bool = False, overwrite: bool = False) -> list[str]:
+        path = os.path.join(dest, filename or self.original_filename)
+        if os.path.exists(path):
+            if not overwrite:
+                return [path]
+            os.remove(path)
+        if export_as_hardlink:
+            os.link(self.source, path)
+        else:
+            shutil.copyfile(self.source, path)
+        return [path]
+
+    def __repr__(self) -> str:
+        return f'SyntheticPhoto({self.uuid}, {self.original_filename})'
+
+class SyntheticPhotosDB:
+
+    def __init__(self, photos: list[SyntheticPhoto]):
+        self._photos = photos
+
+    def photos(self) -> list[SyntheticPhoto]:
+        return list(self._photos)
+
+def generate_sources(directory: str, count: int, jpeg_size: tuple[int, int], movie_seconds: float) -> dict[str, list[str]]:
+    # noise keeps encoded sizes close to real photos; formats without an encoder are left out
+    os.makedirs(directory, exist_ok=True)
+    sources = {'jpeg': [], 'heic': [], 'mov': []}
+    for i in range(count):
+        image = Image.merge('RGB', [Image.effect_noise(jpeg_size, 40 + 10 * band) for band in range(3)])
+        path = os.path.join(directory, f'IMG_{i:04}.jpeg')
+        image.save(path, quality=90)
+        sources['jpeg'].append(path)
+        path = os.path.join(directory, f'IMG_{i:04}.heic')
+        try:
+            image.save(path, format='HEIF', quality=80)
+            sources['heic'].append(path)
+        except (KeyError, OSError):
+            pass
+    if shutil.which('ffmpeg'):
+        for i in range(count):
+            path = os.path.join(directory, f'MOV_{i:04}.mov')
+            subprocess.run(['ffmpeg', '-v', 'error', '-y', '-f', 'lavfi', '-i',
+                            f'testsrc2=size=1920x1080:rate=30:duration={movie_seconds}',
+                            '-c:v', 'libx264', '-pix_fmt', 'yuv420p', path], check=True)
+            sources['mov'].append(path)
+    return {k: v for k, v in sources.items() if v}
+
+def make_games(count: int, start: datetime) -> list[Game]:
+    games = []
+    for i in range(count):
+        start_time = start + timedelta(days=i)
+        games.append(Game(i + 1, f'Benchmark Game {i + 1}', start_time.date(), start_time, start_time,
+                          start_time + timedelta(hours=3)))
+    return games
+
+def make_library(games: list[Game], sources: dict[str, list[str]], photos_per_game: int) -> list[SyntheticPhoto]:
+    # mostly photos, with a movie every tenth item when there are any
+    photos = []
+    kinds = [k for k in ('jpeg', 'heic') if k in sources] or list(sources)
+    for game in games:
+        for i in range(photos_per_game):
+            kind = 'mov' if 'mov' in sources and i % 10 == 9 else kinds[i % len(kinds)]
+            source = sources[kind][i % len(sources[kind])]
+            date = game.StartTime + timedelta(seconds=i * 10800 / photos_per_game)
+            photos.append(SyntheticPhoto(source, date, favorite=i % 25 == 0))
+    return photos
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+class DisposablePostgres:
+
+    def __init__(self, root: str, bin_dir: str | None = None):
+        self.root = root
+        self.port = free_port()
+        self._bin_dir = bin_dir
+
+    def _command(self, name: str) -> str:
+        return os.path.join(self._bin_dir, name) if self._bin_dir else name
+
+    @classmethod
+    def available(cls, bin_dir: str | None = None) -> bool:
+        return shutil.which(os.path.join(bin_dir, 'initdb') if bin_dir else 'initdb') is not None
+
+    def __enter__(self):
+        os.makedirs(self.root, exist_ok=True)
+        data = os.path.join(self.root, 'data')
+        subprocess.run([self._command('initdb'), '-D', data, '-U', 'benchmark', '--auth=trust'],
+                       check=True, capture_output=True)
+        subprocess.run([self._command('pg_ctl'), '-D', data, '-w', '-l', os.path.join(self.root, 'postgres.log'),
+                        '-o', f'-p {self.port} -k {self.root} -c listen_addresses=127.0.0.1 -c fsync=off',
+                        'start'], check=True, capture_output=True)
+        with psycopg.connect(self.connection_info('postgres'), autocommit=True) as connection:
+            connection.execute('CREATE DATABASE benchmark')
+        with psycopg.connect(self.connection_info('benchmark')) as connection:
+            connection.execute(SCHEMA)
+        return self
+
+    def __exit__(self, *exc):
+        subprocess.run([self._command('pg_ctl'), '-D', os.path.join(self.root, 'data'), '-m', 'immediate', 'stop'],
+                       capture_output=True)
+
+    def connection_info(self, database: str) -> str:
+        return f'postgresql://benchmark@127.0.0.1:{self.port}/{database}'
+
+    def write_config(self, path: str, max_pool_size: int):
+        config = {'hostname': f'127.0.0.1:{self.port}', 'database': 'benchmark', 'username': 'benchmark',
+                  'password': '', 'max_pool_size': max_pool_size}
+        with open(path, 'w') as config_file:
+            json.dump(config, config_file)
+
+    def insert_games(self, games: list[Game]) -> list[Game]:
+        with psycopg.connect(self.connection_info('benchmark')) as connection:
+            for game in games:
+                game.Id = connection.execute(
+                    'INSERT INTO "Games"("Name", "Date", "ScheduledTime", "StartTime", "EndTime") '
+                    'VALUES (%s, %s, %s, %s, %s) RETURNING "Id"',
+                    (game.Name, game.Date, game.ScheduledTime, game.StartTime, game.EndTime)).fetchone()[0]
+        return games
+
+    def truncate(self):
+        with psycopg.connect(self.connection_info('benchmark')) as connection:
+            connection.execute('TRUNCATE "RemoteResource" CASCADE')
+
+class LocalS3:
+
+    def __init__(self):
+        self.port = free_port()
+        self._server = ThreadedMotoServer(ip_address='127.0.0.1', port=self.port, verbose=False)
+
+    @classmethod
+    def available(cls) -> bool:
+        return ThreadedMotoServer is not None
+
+    def __enter__(self):
+        self._server.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._server.stop()
+
+    def write_config(self, path: str, max_pool_connections: int):
+        config = {'region': 'us-east-1', 'endpoint': f'http://127.0.0.1:{self.port}', 'bucket': 'benchmark',
+                  'access_key': 'benchmark', 'secret_key': 'benchmark',
+                  'max_pool_connections': max(max_pool_connections, 10)}
+        with open(path, 'w') as config_file:
+            json.dump(config, config_file)
+        client = boto3.client('s3', region_name=config['region'], endpoint_url=config['endpoint'],
+                              aws_access_key_id=config['access_key'], aws_secret_access_key=config['secret_key'])
+        client.create_bucket(Bucket=config['bucket'])
+
+class PeakRss:
+    # without psutil, getrusage only knows the peak over the whole run
+
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self.peak = 0
+        self.source = 'psutil' if psutil else 'getrusage'
+        self._stop = threading.Event()
+
+    def __enter__(self):
+        if psutil:
+            self._thread = threading.Thread(target=self._sample, daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        if psutil:
+            self._stop.set()
+            self._thread.join()
+        else:
+            # kilobytes on Linux, bytes on macOS
+            scale = 1 if sys.platform == 'darwin' else 1024
+            self.peak = scale * max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                                    resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+    def _sample(self):
+        process = psutil.Process()
+        while not self._stop.is_set():
+            rss = 0
+            for p in [process] + process.children(recursive=True):
+                try:
+                    rss += p.memory_info().rss
+                except psutil.Error:
+                    pass
+            self.peak = max(self.peak, rss)
+            self._stop.wait(self.interval)
+
+def percentile(values: list[float], fraction: float) -> float | None:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return round(ordered[min(len(ordered) - 1, max(0, round(fraction * len(ordered)) - 1))], 6)
+
+@dataclass
+class StageResult:
+    stage: str
+    workers: int
+    photos: int = 0
+    bytes: int = 0
+    seconds: float = 0.0
+    errors: int = 0
+    peak_rss: int = 0
+    peak_rss_source: str = ''
+    latencies: list[float] = field(default_factory=list)
+
+    def summary(self) -> dict:
+        return {
+            'stage': self.stage,
+            'workers': self.workers,
+            'photos': self.photos,
+            'bytes': self.bytes,
+            'seconds': round(self.seconds, 4),
+            'errors': self.errors,
+            'photos_per_second': round(self.photos / self.seconds, 2) if self.seconds else None,
+            'bytes_per_second': round(self.bytes / self.seconds) if self.seconds else None,
+            'p50_seconds': percentile(self.latencies, 0.5),
+            'p95_seconds': percentile(self.latencies, 0.95),
+            'peak_rss_bytes': self.peak_rss,
+            'peak_rss_source': self.peak_rss_source,
+        }
+
+def measure(stage: str, workers: int, run) -> StageResult:
+    result = StageResult(stage, workers)
+    with PeakRss() as rss:
+        start = time.perf_counter()
+        run(result)
+        result.seconds = time.perf_counter() - start
+    result.peak_rss, result.peak_rss_source = rss.peak, rss.source
+    return result
+
+class TimedExporter(PhotoExporter):
+    # export_many runs the exports on its own pool, so time them here
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.latencies: list[float] = []
+
+    def export(self, photo, game):
+        start = time.perf_counter()
+        super().export(photo, game)
+        self.latencies.append(time.perf_counter() - start)
+
+class TimedThumbnailer(Thumbnailer):
+    # durations of each job, measured in its worker
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.latencies: list[float] = []
+
+    def completed(self, job, seconds):
+        self.latencies.append(seconds)
+
+class Benchmark:
+
+    def __init__(self, paths: PathManager, games: list[Game], photos: list[SyntheticPhoto], sizes: list[ThumbnailDef],
+                 memory_budget: int | None = None):
+        self.paths = paths
+        self.sizes = sizes
+        self.memory_budget = memory_budget
+        self.games = games
+        self.photos = photos
+        self.exporter = TimedExporter(paths, photosdb=SyntheticPhotosDB(photos))
+        self.exporter.assign_photos_to_games(games)
+        self.manifests: dict[int, dict[str, FileManifest]] = {}
+
+    def exported(self) -> list[tuple[Game, SyntheticPhoto]]:
+        return [(game, photo) for game in self.games for photo in self.exporter.get_exported_photos_for_game(game)]
+
+    def run_export(self, result: StageResult):
+        # start from an empty export directory each time
+        shutil.rmtree(self.paths.root, ignore_errors=True)
+        self.exporter.export_paths.clear()
+        self.exporter.export_workers = result.workers
+        items = [(photo, game) for game in self.games for photo in self.exporter.get_photos_for_game(game)]
+        for photo, _, error in self.exporter.export_many(items):
+            if error:
+                result.errors += 1
+            else:
+                result.photos += 1
+                result.bytes += os.path.getsize(photo.source)
+        result.latencies = self.exporter.latencies
+        self.exporter.latencies = []
+
+    def run_thumbnails(self, result: StageResult):
+        # through thumbnail_iter, so the memory budget scheduler is part of what is measured
+        thumbnailer = TimedThumbnailer(self.sizes, workers=result.workers, memory_budget=self.memory_budget,
+                                       metrics=Metrics())
+        params = [ThumbnailParams(self.exporter.export_paths[p.uuid], p.ismovie, p.uuid, g.Id) for g, p in self.exported()]
+        for p, error in thumbnailer.thumbnail_iter(params):
+            if error:
+                result.errors += 1
+            else:
+                result.photos += 1
+                result.bytes += os.path.getsize(p.path)
+        result.latencies = thumbnailer.latencies
+
+    def scan_manifests(self):
+        for game, photo in self.exported():
+            manifest = FileManifest.scan(self.paths.temp_dir(game, photo), photo, self.paths)
+            self.manifests.setdefault(game.Id, {})[photo.uuid] = manifest
+
+    def run_upload(self, bucket: BucketConnector, result: StageResult, override: bool = True):
+        # without override, files already in the bucket are compared by ETag and skipped
+        params = [p for game in self.games for manifest in self.manifests.get(game.Id, {}).values()
+                  for p in bucket.get_upload_params(manifest, override=override, game_id=game.Id)]
+        for upload in bucket.upload_many_files(params, pool_size=result.workers):
+            if upload.error:
+                result.errors += 1
+            else:
+                result.latencies.append(upload.seconds)
+                result.bytes += upload.bytes
+        result.photos = len({p.photo_uuid for p in params})
+
+    def run_db(self, db: DbConnector, result: StageResult):
+        # one bulk import per game, several games at a time
+        def import_game(game: Game) -> float:
+            photos = self.exporter.get_exported_photos_for_game(game)
+            start = time.perf_counter()
+            db.import_resources(game, photos, manifests=self.manifests.get(game.Id, {}))
+            return time.perf_counter() - start
+
+        with ThreadPoolExecutor(result.workers) as pool:
+            futures = {pool.submit(import_game, game): game for game in self.games}
+            for future, game in futures.items():
+                try:
+                    result.latencies.append(future.result())
+                    result.photos += len(self.exporter.get_exported_photos_for_game(game))
+                except Exception:
+                    result.errors += 1
+
+    def clear_thumbnails(self):
+        for game, photo in self.exported():
+            directory = self.paths.temp_dir(game, photo)
+            for name in os.listdir(directory):
+                if self.paths.get_name_modifier(os.path.splitext(name)[0]) is not None:
+                    os.remove(os.path.join(directory, name))
+
+def print_summary(summary: dict):
+    rate = summary['photos_per_second']
+    mb_rate = (summary['bytes_per_second'] or 0) / 1024 ** 2
+    p50, p95 = summary['p50_seconds'], summary['p95_seconds']
+    print(f"{summary['stage']:>10} x{summary['workers']:<3} {rate or 0:9.1f} photos/s {mb_rate:9.1f} MB/s "
+          f"p50 {1000 * (p50 or 0):8.1f} ms  p95 {1000 * (p95 or 0):8.1f} ms  "
+          f"peak {summary['peak_rss_bytes'] / 1024 ** 2:8.1f} MB  errors {summary['errors']}")
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the import stages against synthetic media and local services.')
+    parser.add_argument('--workers', default='1,2,4,8,12', help='comma separated worker counts to sweep')
+    parser.add_argument('--games', type=int, default=4)
+    parser.add_argument('--photos-per-game', type=int, default=50)
+    parser.add_argument('--sources', type=int, default=8, help='distinct generated files per format')
+    parser.add_argument('--jpeg-size', default='4032x3024')
+    parser.add_argument('--movie-seconds', type=float, default=3)
+    parser.add_argument('--formats', default=None, help=f'thumbnail formats, from {", ".join(WEB_FORMATS)}; plain JPEG by default')
+    parser.add_argument('--memory-budget-gb', type=float, default=None,
+                        help='memory budget for the thumbnail scheduler, defaults to half of physical memory')
+    parser.add_argument('--stages', default='export,thumbnail,upload,db')
+    parser.add_argument('--bucket-config', default=None, help='use an existing local emulator (e.g. MinIO) instead of moto')
+    parser.add_argument('--postgres-bin', default=None, help='directory containing initdb and pg_ctl')
+    parser.add_argument('--workdir', default=None, help='where to generate files, a temporary directory by default')
+    parser.add_argument('--output', default='benchmark-results.json')
+    args = parser.parse_args()
+
+    worker_counts = [int(w) for w in args.workers.split(',')]
+    stages = set(args.stages.split(','))
+    output = os.path.abspath(args.output)
+    workdir = os.path.abspath(args.workdir or tempfile.mkdtemp(prefix='media-benchmark-'))
+    os.makedirs(workdir, exist_ok=True)
+    # PathManager works relative to the current directory
+    os.chdir(workdir)
+
+    width, height = (int(v) for v in args.jpeg_size.split('x'))
+    sources = generate_sources(os.path.join(workdir, 'sources'), args.sources, (width, height), args.movie_seconds)
+    games = make_games(args.games, datetime(2024, 6, 1, 18, tzinfo=timezone.utc))
+
+    results: list[StageResult] = []
+    skipped: dict[str, str] = {}
+
+    def record(result: StageResult):
+        results.append(result)
+        print_summary(result.summary())
+
+    with ExitStack() as services:
+        postgres = None
+        if 'db' in stages:
+            if DisposablePostgres.available(args.postgres_bin):
+                postgres = services.enter_context(DisposablePostgres(os.path.join(workdir, 'postgres'), args.postgres_bin))
+                games = postgres.insert_games(games)
+            else:
+                skipped['db'] = 'initdb not found'
+        bucket_config = args.bucket_config
+        if 'upload' in stages and bucket_config is None:
+            if LocalS3.available():
+                emulator = services.enter_context(LocalS3())
+                bucket_config = os.path.join(workdir, 'benchmark.bucket_config')
+                emulator.write_config(bucket_config, max(worker_counts))
+            else:
+                skipped['upload'] = 'moto is not installed and no --bucket-config was given'
+
+        sizes = with_formats(SIZES, args.formats.split(',')) if args.formats else SIZES
+        paths = PathManager([size.name_modifier for size in sizes])
+        photos = make_library(games, sources, args.photos_per_game)
+        memory_budget = int(args.memory_budget_gb * 1024 ** 3) if args.memory_budget_gb else None
+        benchmark = Benchmark(paths, games, photos, sizes, memory_budget)
+        # everything downstream needs the exported files, so export always runs
+        for workers in worker_counts:
+            record(measure('export', workers, benchmark.run_export))
+
+        if 'thumbnail' in stages:
+            for workers in worker_counts:
+                benchmark.clear_thumbnails()
+                record(measure('thumbnail', workers, benchmark.run_thumbnails))
+        benchmark.scan_manifests()
+
+        if 'upload' in stages and bucket_config is not None:
+            for workers in worker_counts:
+                bucket = BucketConnector(bucket_config, paths)
+                record(measure('upload', workers, lambda result: benchmark.run_upload(bucket, result)))
+            # the same files again, now all in the bucket, with a fresh connector so it lists them
+            for workers in worker_counts:
+                bucket = BucketConnector(bucket_config, paths)
+                record(measure('reupload', workers, lambda result: benchmark.run_upload(bucket, result, override=False)))
+
+        if postgres:
+            postgres_config = os.path.join(workdir, 'benchmark.postgres_config')
+            postgres.write_config(postgres_config, max(worker_counts))
+            for workers in worker_counts:
+                postgres.truncate()
+                with DbConnector(postgres_config, paths) as db:
+                    record(measure('db', workers, lambda result: benchmark.run_db(db, result)))
+
+    report = {
+        'created_at': datetime.now(timezone.utc).isoformat(),
+        'host': {'platform': platform.platform(), 'python': platform.python_version(), 'cpu_count': os.cpu_count()},
+        'settings': {k: v for k, v in vars(args).items() if k != 'output'},
+        'sources': {kind: len(files) for kind, files in sources.items()},
+        'skipped': skipped,
+        'results': [r.summary() for r in results],
+    }
+    with open(output, 'w') as output_file:
+        json.dump(report, output_file, indent=2)
+    for stage, reason in skipped.items():
+        print(f'skipped {stage}: {reason}')
+    print(f'results written to {output}')
+    if args.workdir is None:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
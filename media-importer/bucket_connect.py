@@ -1,13 +1,25 @@
 from dataclasses import dataclass
+import hashlib
+import io
 import json
 import boto3
 import boto3.exceptions
 import boto3.session
-import requests
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
 from osxphotos import PhotoInfo
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from path_management import PathManager
-from multiprocessing import Pool
+from file_manifest import FileManifest, get_file_purpose, get_key
+from journal import ImportJournal, Stage, file_md5
+from metrics import Metrics
+from datetime import datetime
+from typing import Iterable, Iterator
+from urllib.parse import urlparse
 
 @dataclass
 class BucketConfig:
@@ -16,92 +28,319 @@ class BucketConfig:
     bucket: str
     access_key: str
     secret_key: str
+    # transfer settings, all optional in the config file
+    multipart_threshold_mb: int = 16
+    multipart_chunksize_mb: int = 16
+    max_concurrency: int = 4
+    max_pool_connections: int = 50
+    max_retries: int = 2
+
+    @classmethod
+    def load(cls, path: str) -> 'BucketConfig':
+        with open(path, 'r') as config_file:
+            return cls(**json.loads(config_file.read()))
+
+    def target(self) -> str:
+        return f'{urlparse(self.endpoint).netloc or self.endpoint}/{self.bucket}'
+
+    def multipart_threshold(self) -> int:
+        return self.multipart_threshold_mb * 1024 * 1024
+
+    def multipart_chunksize(self) -> int:
+        return self.multipart_chunksize_mb * 1024 * 1024
+
+    def transfer_config(self) -> TransferConfig:
+        return TransferConfig(multipart_threshold=self.multipart_threshold(),
+                              multipart_chunksize=self.multipart_chunksize(),
+                              max_concurrency=self.max_concurrency,
+                              use_threads=self.max_concurrency > 1)
+
+# boto3's default part size, which every object uploaded before the transfer settings became configurable used
+DEFAULT_CHUNKSIZE = 8 * 1024 * 1024
+
+def multipart_etag(source: str | bytes, chunksize: int) -> str:
+    digests = []
+    if isinstance(source, bytes):
+        for i in range(0, len(source), chunksize):
+            digests.append(hashlib.md5(source[i:i + chunksize]).digest())
+    else:
+        with open(source, 'rb') as file:
+            while chunk := file.read(chunksize):
+                digests.append(hashlib.md5(chunk).digest())
+    return f'{hashlib.md5(b"".join(digests)).hexdigest()}-{len(digests)}'
+
+def etag_matches(source: str | bytes, size: int, remote_etag: str, chunksizes: Iterable[int]) -> bool | None:
+    # a multipart ETag records its part count; None if no chunksize gives that many parts
+    digest, _, parts = remote_etag.partition('-')
+    if not parts:
+        return (hashlib.md5(source).hexdigest() if isinstance(source, bytes) else file_md5(source)) == digest
+    for chunksize in dict.fromkeys(chunksizes):
+        if -(-size // chunksize) == int(parts):
+            return multipart_etag(source, chunksize) == remote_etag
+    return None
+
+# S3 serves objects with the type they were uploaded with, which browsers rely on
+CONTENT_TYPES = {
+    '.jpeg': 'image/jpeg',
+    '.jpg': 'image/jpeg',
+    '.webp': 'image/webp',
+    '.avif': 'image/avif',
+    '.heic': 'image/heic',
+    '.png': 'image/png',
+    '.mov': 'video/quicktime',
+    '.mp4': 'video/mp4',
+}
+
+def extra_args(key: str) -> dict:
+    args = {'ACL': 'public-read'}
+    content_type = CONTENT_TYPES.get(os.path.splitext(key)[1].lower())
+    if content_type:
+        args['ContentType'] = content_type
+    return args
 
 @dataclass
 class UploadParams:
     override: bool
     key: str
     file_path: str
+    # identify the photo in the import journal, when one is used
+    photo_uuid: str | None = None
+    game_id: int | None = None
+    # encoded file contents, uploaded from memory instead of reading file_path
+    data: bytes | None = None
+
+@dataclass
+class RemoteObject:
+    key: str
+    size: int
+    etag: str
+    last_modified: datetime | None = None
+
+@dataclass
+class UploadResult:
+    key: str
+    file_path: str
+    # skipped (identical copy in the bucket), uploaded (new key), changed (replaced) or failed
+    status: str = 'skipped'
+    uploaded: bool = False
+    bytes: int = 0
+    seconds: float = 0.0
+    retries: int = 0
+    error: Exception | None = None
 
 class BucketConnector:
 
-    def __init__(self, path: str, path_manager: PathManager):
+    def __init__(self, path: str, path_manager: PathManager, journal: ImportJournal | None = None,
+                 metrics: Metrics | None = None):
         self.path_manager = path_manager
-        with open(path, 'r') as config_file:
-            config_dict = json.loads(config_file.read())
-        self.__config = BucketConfig(**config_dict)
+        self._journal = journal
+        self.metrics = metrics or Metrics()
+        self.__config = BucketConfig.load(path)
+        # cached listing of the bucket by prefix, complete for every prefix it holds
+        self._key_index: dict[str, dict[str, RemoteObject]] = {}
+        self._index_lock = threading.Lock()
+        self._client = None
+        self._client_lock = threading.Lock()
+        self._transfer_config = self.__config.transfer_config()
+        # every upload result this run, for write_report
+        self.run_results: list[UploadResult] = []
+        self._results_lock = threading.Lock()
 
     def get_client(self):
-        return boto3.client('s3',
-                              region_name=self.__config.region,
-                              endpoint_url=self.__config.endpoint,
-                              aws_access_key_id=self.__config.access_key,
-                              aws_secret_access_key=self.__config.secret_key)
+        # boto3 clients are thread safe, so every upload thread shares this one
+        with self._client_lock:
+            if self._client is None:
+                self._client = boto3.client('s3',
+                                            region_name=self.__config.region,
+                                            endpoint_url=self.__config.endpoint,
+                                            aws_access_key_id=self.__config.access_key,
+                                            aws_secret_access_key=self.__config.secret_key,
+                                            config=Config(max_pool_connections=self.__config.max_pool_connections))
+            return self._client
 
     def get_file_purpose(self, name_modifier: str | None, ext: str, photo: PhotoInfo, has_alternate_formats: bool) -> str:
-        if photo.ismovie and ext == '.jpeg':
-            return 'thumbnail'
-        elif name_modifier is not None:
-            return 'thumbnail'
-        elif has_alternate_formats and ext == '.jpeg':
-            return 'alt'
-        else:
-            return 'original'
+        return get_file_purpose(name_modifier, ext, photo.ismovie, has_alternate_formats).key_name
 
     def get_key(self, photo: PhotoInfo, name_modifier: str | None, ext: str, has_alternate_formats: bool) -> str:
-        base = self.get_file_purpose(name_modifier, ext, photo, has_alternate_formats)
-        if name_modifier:
-            base = f'{base}_{name_modifier}'
-        return f'{photo.uuid}/{base}{ext}'
+        purpose = get_file_purpose(name_modifier, ext, photo.ismovie, has_alternate_formats)
+        return get_key(photo.uuid, purpose, name_modifier, ext)
 
     def file_exists(self, photo: PhotoInfo, name_modifier: str, ext: str, has_alternate_formats: bool) -> bool:
         key = self.get_key(photo, name_modifier, ext, has_alternate_formats)
         return self.file_exists_by_key(key)
     
     def file_exists_by_key(self, key: str) -> bool:
-        base = f'https://{self.__config.bucket}.{self.__config.region}.digitaloceanspaces.com'
-        request = requests.head(f'{base}/{key}')
-        return request.status_code == 200
+        return self.get_remote_object(key) is not None
+
+    def key_prefix(self, key: str) -> str:
+        # keys are always {uuid}/{name}, so the uuid directory is the natural listing unit
+        return key.split('/', 1)[0] + '/'
+
+    def get_remote_object(self, key: str) -> RemoteObject | None:
+        prefix = self.key_prefix(key)
+        if prefix not in self._key_index:
+            self.load_key_index([prefix])
+        return self._key_index[prefix].get(key)
+
+    def indexed_object(self, key: str) -> RemoteObject | None:
+        # only what is already listed, never a new request
+        return self._key_index.get(self.key_prefix(key), {}).get(key)
+
+    def load_key_index(self, prefixes: Iterable[str], refresh: bool = False):
+        # prefixes already loaded are skipped unless refresh
+        to_load = [p for p in set(prefixes) if refresh or p not in self._key_index]
+        if len(to_load) == 0:
+            return
+        paginator = self.get_client().get_paginator('list_objects_v2')
+        for prefix in to_load:
+            objects = []
+            for page in paginator.paginate(Bucket=self.__config.bucket, Prefix=prefix):
+                self.metrics.count('bucket', 'list_requests')
+                for obj in page.get('Contents', []):
+                    objects.append(self.remote_object(obj))
+            # uploads for different photos may refresh the index from several threads
+            with self._index_lock:
+                self._key_index[prefix] = {obj.key: obj for obj in objects}
     
+    def remote_object(self, obj: dict) -> RemoteObject:
+        return RemoteObject(obj['Key'], obj['Size'], obj['ETag'].strip('"'), obj.get('LastModified'))
+
+    def list_all_objects(self) -> Iterator[RemoteObject]:
+        paginator = self.get_client().get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.__config.bucket):
+            self.metrics.count('bucket', 'list_requests')
+            for obj in page.get('Contents', []):
+                yield self.remote_object(obj)
+
+    def delete_keys(self, keys: list[str], batch_size: int = 1000, max_requests_per_second: float | None = None) -> list[str]:
+        # returns the keys that failed
+        client = self.get_client()
+        failed = []
+        # larger batches fail the whole request
+        batch_size = max(1, min(batch_size, 1000))
+        for i in range(0, len(keys), batch_size):
+            start = time.perf_counter()
+            batch = keys[i:i + batch_size]
+            with self.metrics.timer('bucket', 'delete'):
+                response = client.delete_objects(Bucket=self.__config.bucket,
+                                                  Delete={'Objects': [{'Key': key} for key in batch], 'Quiet': True})
+            errors = [error['Key'] for error in response.get('Errors', [])]
+            failed.extend(errors)
+            self.metrics.count('bucket', 'deleted', len(batch) - len(errors))
+            with self._index_lock:
+                for key in batch:
+                    self._key_index.get(self.key_prefix(key), {}).pop(key, None)
+            if max_requests_per_second:
+                time.sleep(max(0.0, 1 / max_requests_per_second - (time.perf_counter() - start)))
+        return failed
+
     def upload_by_key(self, path: str, key: str):
         client = self.get_client()
-        client.upload_file(path, self.__config.bucket, key, ExtraArgs={'ACL':'public-read'})
+        client.upload_file(path, self.__config.bucket, key, 
+                           ExtraArgs=extra_args(key), 
+                           Config=self._transfer_config)
+
+    def upload_fileobj_by_key(self, fileobj, key: str):
+        client = self.get_client()
+        client.upload_fileobj(fileobj, self.__config.bucket, key,
+                              ExtraArgs=extra_args(key),
+                              Config=self._transfer_config)
 
     def upload_file(self, path: str, photo: PhotoInfo, name_modifier: str, ext: str, has_alternate_formats: bool):
         key = self.get_key(photo, name_modifier, ext, has_alternate_formats)
         self.upload_by_key(path, key)
 
-    def get_upload_params(self, root_path: str, photo: PhotoInfo, override: bool = False):
-        original_formats_count = 0
-        for file in os.listdir(root_path):
-            name, ext = os.path.splitext(file)
-            name_modifier = self.path_manager.get_name_modifier(name)
-            if name_modifier is None:
-                original_formats_count += 1
-
-        has_alternate_formats = original_formats_count > 1
+    def get_upload_params(self, manifest: FileManifest, override: bool = False, game_id: int | None = None) -> list[UploadParams]:
+        return [UploadParams(override, entry.key, entry.path, manifest.photo_uuid, game_id, entry.data)
+                for entry in manifest]
 
-        params: list[UploadParams] = []
-
-        for file in os.listdir(root_path):
-            name, ext = os.path.splitext(file)
-            name_modifier = self.path_manager.get_name_modifier(name)
-            key = self.get_key(photo, name_modifier, ext, has_alternate_formats)
-            full_path = os.path.join(root_path, file)
-            params.append(UploadParams(override, key, full_path))
+    def upload_many_files(self, params: list[UploadParams], pool_size=12, executor: ThreadPoolExecutor | None = None) -> list[UploadResult]:
+        if self._journal:
+            params = [p for p in params if not self.is_journaled(p)]
+        # build the index up front so the workers only read from it; forced uploads don't need it
+        self.load_key_index({self.key_prefix(p.key) for p in params if not p.override})
+        if executor is not None:
+            # a pool shared by several callers, which caps their uploads together
+            results = list(executor.map(self.upload_parallelizable, params))
+        else:
+            with ThreadPoolExecutor(pool_size) as executor:
+                results = list(executor.map(self.upload_parallelizable, params))
+        # only prefixes we are tracking need to see the new objects
+        changed = {self.key_prefix(r.key) for r in results if r.uploaded}
+        self.load_key_index([p for p in changed if p in self._key_index], refresh=True)
+        with self._results_lock:
+            self.run_results.extend(results)
+        if self._journal:
+            self.record_uploads(params, results)
+        return results
 
-        return params
+    def is_journaled(self, params: UploadParams) -> bool:
+        return params.photo_uuid is not None and self._journal.is_done(params.photo_uuid, params.game_id, Stage.UPLOADED)
 
-    def upload_many_files(self, params: list[UploadParams], pool_size=12):
-        with Pool(pool_size) as pool:
-            results = pool.map(self.upload_parallelizable, params)
-        for result in results:
-            if result:
-                print('Error: ', result)
+    def record_uploads(self, params: list[UploadParams], results: list[UploadResult]):
+        # a photo only counts as uploaded once every one of its files made it
+        by_photo: dict[tuple[str, int], list[tuple[UploadParams, UploadResult]]] = {}
+        for p, result in zip(params, results):
+            if p.photo_uuid is not None:
+                by_photo.setdefault((p.photo_uuid, p.game_id), []).append((p, result))
+        for (photo_uuid, game_id), uploads in by_photo.items():
+            if all(result.error is None for _, result in uploads):
+                files = {p.key: p.data if p.data is not None else p.file_path for p, _ in uploads}
+                self._journal.record(photo_uuid, game_id, Stage.UPLOADED, files)
 
-    def upload_parallelizable(self, params: UploadParams):
+    def upload_parallelizable(self, params: UploadParams) -> UploadResult:
+        result = UploadResult(params.key, params.file_path)
+        start = time.perf_counter()
         try:
-            if params.override or not self.file_exists_by_key(params.key):
-                self.upload_by_key(params.file_path, params.key)
+            # forced uploads only use what is already indexed, to report replaced keys
+            remote = self.indexed_object(params.key) if params.override else self.get_remote_object(params.key)
+            if params.override or not self.matches_remote(params, remote):
+                while True:
+                    try:
+                        if params.data is not None:
+                            self.upload_fileobj_by_key(io.BytesIO(params.data), params.key)
+                        else:
+                            self.upload_by_key(params.file_path, params.key)
+                        break
+                    # upload_file and multipart uploads wrap client errors in S3UploadFailedError
+                    except (BotoCoreError, ClientError, boto3.exceptions.S3UploadFailedError):
+                        if result.retries >= self.__config.max_retries:
+                            raise
+                        result.retries += 1
+                        self.metrics.count('bucket', 'retries')
+                result.status = 'uploaded' if remote is None else 'changed'
+                result.uploaded = True
+                result.bytes = len(params.data) if params.data is not None else os.path.getsize(params.file_path)
         except Exception as e:
-            return e
\ No newline at end of file
+            result.status = 'failed'
+            result.error = e
+        result.seconds = time.perf_counter() - start
+        self.metrics.observe('bucket', 'upload', result.seconds)
+        self.metrics.count('bucket', result.status)
+        self.metrics.count('bucket', 'bytes_uploaded', result.bytes)
+        return result
+
+    def matches_remote(self, params: UploadParams, remote: RemoteObject | None) -> bool:
+        if remote is None:
+            return False
+        source = params.data if params.data is not None else params.file_path
+        size = len(source) if params.data is not None else os.path.getsize(source)
+        if size != remote.size:
+            return False
+        matches = etag_matches(source, size, remote.etag, [self.__config.multipart_chunksize(), DEFAULT_CHUNKSIZE])
+        if matches is None:
+            # uploaded with a part size we no longer know, so the equal size has to do
+            self.metrics.count('bucket', 'etag_unverified')
+            return True
+        return matches
+
+    def write_report(self, path: str):
+        report = {status: [] for status in ['skipped', 'uploaded', 'changed', 'failed']}
+        for result in self.run_results:
+            entry = {'key': result.key, 'bytes': result.bytes, 'seconds': round(result.seconds, 3)}
+            if result.error:
+                entry['error'] = str(result.error)
+            report[result.status].append(entry)
+        report['summary'] = {status: len(report[status]) for status in list(report)}
+        with open(path, 'w') as report_file:
+            json.dump(report, report_file, indent=2)
@@ -0,0 +1,78 @@
+import argparse
+import re
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+
+from bucket_connect import BucketConnector, RemoteObject
+from db_connect import DbConnector
+from path_management import PathManager
+
+# only keys written by the importers ({UUID}/{name}) are ever considered for deletion
+MANAGED_KEY = re.compile(r'^[0-9A-F]{8}-[0-9A-F]{4}-[0-9A-F]{4}-[0-9A-F]{4}-[0-9A-F]{12}/[^/]+$')
+
+@dataclass
+class ReconcileReport:
+    listed: int = 0
+    live: int = 0
+    orphans: list[RemoteObject] = field(default_factory=list)
+    # orphans younger than min_age, which may belong to an import still in progress
+    recent: int = 0
+    failed: list[str] = field(default_factory=list)
+    deleted: int = 0
+
+    @property
+    def orphan_bytes(self) -> int:
+        return sum(o.size for o in self.orphans)
+
+def reconcile(db: DbConnector, bucket: BucketConnector, dry_run: bool = True, min_age: timedelta = timedelta(days=1),
+              batch_size: int = 1000, max_requests_per_second: float | None = None) -> ReconcileReport:
+    report = ReconcileReport()
+    live_keys = db.get_live_keys()
+    report.live = len(live_keys)
+    cutoff = datetime.now(timezone.utc) - min_age
+    for obj in bucket.list_all_objects():
+        report.listed += 1
+        if obj.key in live_keys or not MANAGED_KEY.match(obj.key):
+            continue
+        if obj.last_modified is not None and obj.last_modified > cutoff:
+            report.recent += 1
+            continue
+        report.orphans.append(obj)
+
+    if not dry_run and report.orphans:
+        keys = [o.key for o in report.orphans]
+        report.failed = bucket.delete_keys(keys, batch_size, max_requests_per_second)
+        report.deleted = len(keys) - len(report.failed)
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description='Delete bucket objects that are no longer referenced by the database.')
+    parser.add_argument('--postgres-config', default='./prod.postgres_config')
+    parser.add_argument('--bucket-config', default='./prod.bucket_config')
+    parser.add_argument('--delete', action='store_true', help='actually delete the orphans; by default only report them')
+    parser.add_argument('--min-age-hours', type=float, default=24, help='leave orphans younger than this alone')
+    parser.add_argument('--batch-size', type=int, default=1000, help='keys per DeleteObjects request, at most 1000')
+    parser.add_argument('--max-requests-per-second', type=float, default=None)
+    parser.add_argument('--verbose', action='store_true', help='print every orphaned key')
+    args = parser.parse_args()
+
+    paths = PathManager([])
+    bucket = BucketConnector(args.bucket_config, paths)
+    with DbConnector(args.postgres_config, paths) as db:
+        report = reconcile(db, bucket, dry_run=not args.delete, min_age=timedelta(hours=args.min_age_hours),
+                           batch_size=args.batch_size, max_requests_per_second=args.max_requests_per_second)
+
+    if args.verbose:
+        for obj in report.orphans:
+            print(obj.key, obj.size)
+    print(f'{report.listed} objects listed, {report.live} live keys in the database')
+    print(f'{len(report.orphans)} orphans ({report.orphan_bytes / 1024 ** 2:.1f} MB), {report.recent} more too recent to touch')
+    if args.delete:
+        print(f'{report.deleted} deleted, {len(report.failed)} failed')
+        for key in report.failed:
+            print('Error: ', key)
+    else:
+        print('dry run, nothing deleted (pass --delete to remove them)')
+
+if __name__ == '__main__':
+    main()
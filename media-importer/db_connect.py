@@ -1,11 +1,21 @@
-from dataclasses import dataclass
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from functools import partial
 import json
 import psycopg
+import threading
 from psycopg.rows import dict_row
+from psycopg_pool import ConnectionPool
 from path_management import Game, PathManager
+from journal import ImportJournal, Stage
+from metrics import Metrics
+from file_manifest import FileManifest, FilePurpose, get_file_purpose, get_key
+from bucket_connect import BucketConnector, UploadParams
 from osxphotos import PhotoInfo
 import os
-from datetime import date
+import uuid
+from datetime import date, datetime
+from typing import Iterator
 
 @dataclass
 class PostgresConfig:
@@ -13,37 +23,119 @@ class PostgresConfig:
     database: str
     username: str
     password: str
+    # connection pool settings, all optional in the config file
+    min_pool_size: int = 1
+    max_pool_size: int = 4
+    max_idle: float = 300.0
+    check_connections: bool = True
+
+    @classmethod
+    def load(cls, path: str) -> 'PostgresConfig':
+        with open(path, 'r') as config_file:
+            return cls(**json.loads(config_file.read()))
 
     def connection_info(self) -> str:
         return f'postgresql://{self.username}:{self.password}@{self.hostname}/{self.database}'
 
+    def target(self) -> str:
+        return f'{self.hostname}/{self.database}'
+
+
+@dataclass
+class ScorecardLookup:
+    games: dict[int, Game] = field(default_factory=dict)
+    by_name: dict[str, int] = field(default_factory=dict)
+    by_date: dict[date, list[int]] = field(default_factory=dict)
+    with_scorecard: set[int] = field(default_factory=set)
+
+
+class MeasuredCursor(psycopg.Cursor):
+    # executemany counts as one round trip
+
+    def __init__(self, connection, *, row_factory=None, metrics: Metrics):
+        super().__init__(connection, row_factory=row_factory)
+        self._metrics = metrics
+
+    def execute(self, query, params=None, **kwargs):
+        self._metrics.count('db', 'round_trips')
+        with self._metrics.timer('db', 'execute'):
+            return super().execute(query, params, **kwargs)
+
+    def executemany(self, query, params_seq, **kwargs):
+        self._metrics.count('db', 'round_trips')
+        with self._metrics.timer('db', 'executemany'):
+            return super().executemany(query, params_seq, **kwargs)
+
 
 class DbConnector:
 
-    def __init__(self, path: str, path_manager: PathManager):
+    def __init__(self, path: str, path_manager: PathManager, journal: ImportJournal | None = None,
+                 metrics: Metrics | None = None):
         self._path_manager = path_manager
-        with open(path, 'r') as config_file:
-            config_dict = json.loads(config_file.read())
-        self.__config = PostgresConfig(**config_dict)
+        self._journal = journal
+        self.metrics = metrics or Metrics()
+        self.__config = PostgresConfig.load(path)
+        # opened on first use; a closed pool can't be reopened, so close() drops it
+        self.__pool: ConnectionPool | None = None
+        self.__pool_lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        with self.__pool_lock:
+            if self.__pool is not None:
+                self.__pool.close()
+                self.__pool = None
+
+    def pool(self) -> ConnectionPool:
+        with self.__pool_lock:
+            if self.__pool is None:
+                pool = ConnectionPool(self.__config.connection_info(),
+                                      min_size=self.__config.min_pool_size,
+                                      max_size=self.__config.max_pool_size,
+                                      max_idle=self.__config.max_idle,
+                                      check=ConnectionPool.check_connection if self.__config.check_connections else None,
+                                      configure=self._configure,
+                                      open=False)
+                pool.open(wait=True)
+                self.__pool = pool
+            return self.__pool
+
+    def _configure(self, connection: psycopg.Connection):
+        connection.cursor_factory = partial(MeasuredCursor, metrics=self.metrics)
+
+    @contextmanager
+    def connection(self):
+        with self.pool().connection() as connection:
+            yield connection
 
 
     def get_games(self, from_date: date = None, to_date: date = None) -> list[Game]:
-        with psycopg.connect(self.__config.connection_info()) as connection:
-            with connection.cursor(row_factory=dict_row) as cursor:
-                games_q = cursor.execute('SELECT "Id", "Name", "Date", "ScheduledTime", "StartTime", "EndTime" FROM "Games"')
-                games = games_q.fetchall()
-                results = [Game(**g) for g in games]
-        
-        if from_date:
-            results = [g for g in results if g.Date >= from_date]
-        if to_date:
-            results = [g for g in results if g.Date <= to_date]
-
-        return results
+        return list(self.iter_games(from_date, to_date))
+
+    def iter_games(self, from_date: date = None, to_date: date = None, batch_size: int = 100) -> Iterator[Game]:
+        # at most batch_size rows are held at once
+        statement = """
+        SELECT "Id", "Name", "Date", "ScheduledTime", "StartTime", "EndTime"
+        FROM "Games"
+        WHERE (%(from_date)s::date IS NULL OR "Date" >= %(from_date)s::date)
+            AND (%(to_date)s::date IS NULL OR "Date" <= %(to_date)s::date)
+        ORDER BY "Date", "StartTime"
+        """
+        with self.connection() as connection:
+            with connection.cursor(name='iter_games', row_factory=dict_row) as cursor:
+                cursor.itersize = batch_size
+                cursor.execute(statement, {'from_date': from_date, 'to_date': to_date})
+                for g in cursor:
+                    yield Game(**g)
     
     def get_game_by_id(self, id: int) -> Game:
         statement = 'SELECT "Id", "Name", "Date", "ScheduledTime", "StartTime", "EndTime" FROM "Games" WHERE "Id" = %s'
-        with psycopg.connect(self.__config.connection_info()) as connection:
+        with self.connection() as connection:
             with connection.cursor(row_factory=dict_row) as cursor:
                 games_q = cursor.execute(statement, (id,))
                 g = games_q.fetchone()
@@ -55,7 +147,7 @@ class DbConnector:
         FROM "Games"
         WHERE "Games"."Name" = %s
         """
-        with psycopg.connect(self.__config.connection_info()) as connection:
+        with self.connection() as connection:
             with connection.cursor() as cursor:
                 result = cursor.execute(statement, (name,))
                 id = result.fetchone()
@@ -70,7 +162,7 @@ class DbConnector:
         FROM "Games"
         WHERE "Games"."Date" = %s
         """
-        with psycopg.connect(self.__config.connection_info()) as connection:
+        with self.connection() as connection:
             with connection.cursor() as cursor:
                 result = cursor.execute(statement, (date,))
                 ids = result.fetchall()
@@ -86,7 +178,7 @@ class DbConnector:
         FROM "Games"
         WHERE "Games"."Id" = %s
         """
-        with psycopg.connect(self.__config.connection_info()) as connection:
+        with self.connection() as connection:
             with connection.cursor() as cursor:
                 result = cursor.execute(statement, (game_id,))
                 id = result.fetchone()
@@ -95,22 +187,24 @@ class DbConnector:
                 else:
                     return False
 
-    def get_db_id(self, photo_uuid: str) -> int | None:
+    def get_db_id(self, photo_uuid: str, cursor=None) -> int | None:
         statement = """
         SELECT "Id"
         FROM "RemoteResource"
         WHERE "RemoteResource"."AssetIdentifier" = %s
         """
-        with psycopg.connect(self.__config.connection_info()) as connection:
-            with connection.cursor() as cursor:
-                result = cursor.execute(statement, (photo_uuid,))
-                id = result.fetchone()
-                if id:
-                    return id[0]
-                else:
-                    return None
+        if cursor is None:
+            with self.connection() as connection:
+                with connection.cursor() as cursor:
+                    return self.get_db_id(photo_uuid, cursor)
+        result = cursor.execute(statement, (photo_uuid,))
+        id = result.fetchone()
+        if id:
+            return id[0]
+        else:
+            return None
             
-    def file_exists(self, photo_uuid: str, name_modifier: str, ext: str) -> bool:
+    def file_exists(self, photo_uuid: str, name_modifier: str, ext: str, cursor=None) -> bool:
         statement = """
         SELECT COUNT(*)
         FROM "RemoteResource"
@@ -119,10 +213,12 @@ class DbConnector:
             AND COALESCE("RemoteFile"."NameModifier", 'null') = COALESCE(%s, 'null')
             AND "RemoteFile"."Extension" = %s
         """
-        with psycopg.connect(self.__config.connection_info()) as connection:
-            with connection.cursor() as cursor:
-                count = cursor.execute(statement, (photo_uuid, name_modifier, ext))
-                return count.fetchone()[0] > 0
+        if cursor is None:
+            with self.connection() as connection:
+                with connection.cursor() as cursor:
+                    return self.file_exists(photo_uuid, name_modifier, ext, cursor)
+        count = cursor.execute(statement, (photo_uuid, name_modifier, ext))
+        return count.fetchone()[0] > 0
             
     def resource_type(self, photo: PhotoInfo) -> int:
         if photo.ismovie:
@@ -146,34 +242,17 @@ class DbConnector:
         )
 
     def get_file_purpose(self, name_modifier: str | None, ext: str, photo: PhotoInfo, has_alternate_formats: bool) -> int:
-        if photo.ismovie and ext == '.jpeg':
-            return 2 # Thumbnail
-        elif name_modifier is not None:
-            return 2 # Thumbnail
-        elif has_alternate_formats and ext == '.jpeg':
-            return 3 # Alternate Format
-        else:
-            return 1 # Original
-
-    def get_file_params(self, resourceId: int, game: Game, photo: PhotoInfo) -> list[tuple]:
-        out_dir = self._path_manager.temp_dir(game, photo)
-        results = []
-        original_formats_count = 0
-        for file in os.listdir(out_dir):
-            name, ext = os.path.splitext(os.path.basename(file))
-            name_modifier = self._path_manager.get_name_modifier(name)
-            if name_modifier is None:
-                original_formats_count += 1
-
-        for file in os.listdir(out_dir):
-            name, ext = os.path.splitext(os.path.basename(file))
-            name_modifier = self._path_manager.get_name_modifier(name)
-            file_purpose = self.get_file_purpose(name_modifier, ext, photo, original_formats_count > 1)
-            
-            results.append((resourceId, file_purpose, name_modifier, ext))
-        return results
+        return int(get_file_purpose(name_modifier, ext, photo.ismovie, has_alternate_formats))
+
+    def get_manifest(self, game: Game, photo: PhotoInfo, manifests: dict[str, FileManifest] | None = None) -> FileManifest:
+        if manifests and photo.uuid in manifests:
+            return manifests[photo.uuid]
+        return FileManifest.scan(self._path_manager.temp_dir(game, photo), photo, self._path_manager)
+
+    def get_file_params(self, resourceId: int, manifest: FileManifest) -> list[tuple]:
+        return [(resourceId, int(entry.purpose), entry.name_modifier, entry.ext) for entry in manifest]
 
-    def import_files(self, resourceId: int, game: Game, photo: PhotoInfo, cursor):
+    def import_files(self, resourceId: int, game: Game, photo: PhotoInfo, cursor, manifest: FileManifest | None = None):
         statement = """
             INSERT INTO "RemoteFile"("ResourceId", 
                                         "Purpose", 
@@ -181,11 +260,28 @@ class DbConnector:
                                         "Extension") 
             VALUES (%s, %s, %s, %s)
         """
-        for params in self.get_file_params(resourceId, game, photo):
-            if not self.file_exists(photo.uuid, params[2], params[3]):
+        if manifest is None:
+            manifest = self.get_manifest(game, photo)
+        for params in self.get_file_params(resourceId, manifest):
+            if not self.file_exists(photo.uuid, params[2], params[3], cursor):
                 cursor.execute(statement, params)
 
-    def import_resources(self, game: Game, photos: list[PhotoInfo]):
+    def import_resources(self, game: Game, photos: list[PhotoInfo], bulk: bool = True, 
+                         manifests: dict[str, FileManifest] | None = None):
+        # photos without a manifest are scanned from their temp dir
+        if self._journal:
+            photos = [p for p in photos if not self._journal.is_done(p.uuid, game.Id, Stage.RECORDED)]
+        with self.metrics.timer('db', 'import_resources'):
+            if bulk:
+                self.import_resources_bulk(game, photos, manifests)
+            else:
+                self.import_resources_by_row(game, photos, manifests)
+        self.metrics.count('db', 'recorded', len(photos))
+        if self._journal:
+            for photo in photos:
+                self._journal.record(photo.uuid, game.Id, Stage.RECORDED)
+
+    def import_resources_by_row(self, game: Game, photos: list[PhotoInfo], manifests: dict[str, FileManifest] | None = None):
         statement = """
             INSERT INTO "RemoteResource"("AssetIdentifier", 
                                         "DateTime", 
@@ -197,18 +293,89 @@ class DbConnector:
             VALUES (%s, %s, %s, %s, %s, %s, %s)
             RETURNING "Id"
         """
-        with psycopg.connect(self.__config.connection_info()) as connection:
+        with self.connection() as connection:
             with connection.cursor() as cursor:
                 for photo in photos:
-                    id = self.get_db_id(photo.uuid)
+                    id = self.get_db_id(photo.uuid, cursor)
                     if id is None:
                         params = self.get_params(game.Id, photo)
                         cursor.execute(statement, params)
                         id = cursor.fetchone()[0]
-                    self.import_files(id, game, photo, cursor)
+                    self.import_files(id, game, photo, cursor, self.get_manifest(game, photo, manifests))
             
             connection.commit()
 
+    def get_existing_keys(self, photo_uuids: list[str], cursor) -> tuple[dict[str, int], set[tuple[str, str | None, str]]]:
+        statement = """
+        SELECT UPPER("RemoteResource"."AssetIdentifier"::varchar),
+               "RemoteResource"."Id",
+               "RemoteFile"."NameModifier",
+               "RemoteFile"."Extension"
+        FROM "RemoteResource"
+        LEFT JOIN "RemoteFile" ON "RemoteResource"."Id" = "RemoteFile"."ResourceId"
+        WHERE "RemoteResource"."AssetIdentifier" = ANY(%s::uuid[])
+        """
+        resource_ids: dict[str, int] = {}
+        file_keys: set[tuple[str, str | None, str]] = set()
+        for identifier, resource_id, name_modifier, ext in cursor.execute(statement, (photo_uuids,)):
+            resource_ids[identifier] = resource_id
+            if ext is not None:
+                file_keys.add((identifier, name_modifier, ext))
+        return resource_ids, file_keys
+
+    def insert_resources_bulk(self, game: Game, photos: list[PhotoInfo], cursor) -> dict[str, int]:
+        # existing rows are left untouched
+        return self.insert_resource_rows([self.get_params(game.Id, photo) for photo in photos], cursor)
+
+    def insert_resource_rows(self, rows: list[tuple], cursor) -> dict[str, int]:
+        # rows are in the column order of get_params
+        statement = """
+            INSERT INTO "RemoteResource"("AssetIdentifier", 
+                                        "DateTime", 
+                                        "OriginalFileName", 
+                                        "GameId", 
+                                        "Discriminator", 
+                                        "ResourceType", 
+                                        "Favorite") 
+            SELECT * FROM unnest(%s::uuid[], %s::timestamptz[], %s::text[], %s::bigint[], 
+                                 %s::text[], %s::int[], %s::boolean[])
+            ON CONFLICT ("AssetIdentifier") DO NOTHING
+            RETURNING UPPER("AssetIdentifier"::varchar), "Id"
+        """
+        if len(rows) == 0:
+            return {}
+        columns = list(zip(*rows))
+        cursor.execute(statement, [list(column) for column in columns])
+        return {identifier: id for identifier, id in cursor.fetchall()}
+
+    def import_resources_bulk(self, game: Game, photos: list[PhotoInfo], manifests: dict[str, FileManifest] | None = None):
+        file_statement = """
+            INSERT INTO "RemoteFile"("ResourceId", 
+                                        "Purpose", 
+                                        "NameModifier", 
+                                        "Extension") 
+            VALUES (%s, %s, %s, %s)
+            ON CONFLICT DO NOTHING
+        """
+        if len(photos) == 0:
+            return
+        with self.connection() as connection:
+            with connection.cursor() as cursor:
+                resource_ids, file_keys = self.get_existing_keys([p.uuid for p in photos], cursor)
+                missing = [p for p in photos if p.uuid.upper() not in resource_ids]
+                resource_ids.update(self.insert_resources_bulk(game, missing, cursor))
+
+                file_params = []
+                for photo in photos:
+                    identifier = photo.uuid.upper()
+                    manifest = self.get_manifest(game, photo, manifests)
+                    for params in self.get_file_params(resource_ids[identifier], manifest):
+                        # NULL name modifiers never conflict in the unique index, so filter here too
+                        if (identifier, params[2], params[3]) not in file_keys:
+                            file_params.append(params)
+                if file_params:
+                    cursor.executemany(file_statement, file_params)
+
     def import_scorecard_file(self, resource_id: int, ext: str, cursor):
         statement = """
             INSERT INTO "RemoteFile"("ResourceId", 
@@ -237,7 +404,7 @@ class DbConnector:
         SET "ScorecardId" = %s
         WHERE "Id" = %s
         """
-        with psycopg.connect(self.__config.connection_info()) as connection:
+        with self.connection() as connection:
             with connection.cursor() as cursor:
                 params = (identifier, game.EndTime, original_name, game.Id, 'Scorecard', 1, False)
                 cursor.execute(statement, params)
@@ -245,6 +412,106 @@ class DbConnector:
                 self.import_scorecard_file(id, ext, cursor)
                 cursor.execute(update_statement, (id, game.Id))
 
+    def get_scorecard_lookup(self) -> ScorecardLookup:
+        statement = 'SELECT "Id", "Name", "Date", "ScheduledTime", "StartTime", "EndTime", "ScorecardId" FROM "Games"'
+        lookup = ScorecardLookup()
+        with self.connection() as connection:
+            with connection.cursor(row_factory=dict_row) as cursor:
+                for row in cursor.execute(statement):
+                    scorecard_id = row.pop('ScorecardId')
+                    game = Game(**row)
+                    lookup.games[game.Id] = game
+                    lookup.by_name[game.Name] = game.Id
+                    lookup.by_date.setdefault(game.Date, []).append(game.Id)
+                    if scorecard_id is not None:
+                        lookup.with_scorecard.add(game.Id)
+        return lookup
+
+    def resolve_scorecard(self, file_name: str, lookup: ScorecardLookup) -> int | None:
+        # match on the game name, falling back to a unique game on the date the name starts with
+        game_name = os.path.splitext(file_name)[0]
+        game_id = lookup.by_name.get(game_name)
+        if game_id is None:
+            try:
+                game_date = datetime.strptime(game_name[:8], '%y-%m-%d').date()
+            except ValueError:
+                print(f'failed to parse date from {file_name}')
+                return None
+            ids = lookup.by_date.get(game_date, [])
+            # if there are multiple games on the same day don't return any of them
+            game_id = ids[0] if len(ids) == 1 else None
+        return game_id
+
+    def import_scorecards(self, scorecards_location: str, bucket: BucketConnector, pool_size: int = 8) -> list[str]:
+        # returns the imported file names
+        lookup = self.get_scorecard_lookup()
+        to_import: dict[str, tuple[Game, str, str]] = {}
+        upload_params: list[UploadParams] = []
+        for file_name in sorted(os.listdir(scorecards_location)):
+            game_id = self.resolve_scorecard(file_name, lookup)
+            if not game_id:
+                print(f'Could not identify unique game for {file_name}. Skipping')
+                continue
+            elif game_id in lookup.with_scorecard:
+                print(f'Game for {file_name} already has scorecard, skipping')
+                continue
+            print(f'Processing scorecard {file_name}')
+            lookup.with_scorecard.add(game_id)
+            identifier = str(uuid.uuid4()).upper()
+            extension = os.path.splitext(file_name)[1]
+            key = f'{identifier}/original{extension}'
+            to_import[key] = (lookup.games[game_id], identifier, file_name)
+            # a fresh identifier can't already be in the bucket, so skip the existence check
+            upload_params.append(UploadParams(True, key, os.path.join(scorecards_location, file_name)))
+
+        results = bucket.upload_many_files(upload_params, pool_size=pool_size)
+        uploaded = []
+        for result in results:
+            if result.error:
+                print(f'Error uploading {to_import[result.key][2]}: {result.error}')
+            else:
+                uploaded.append(to_import[result.key])
+        if len(uploaded) == 0:
+            return []
+
+        file_statement = """
+            INSERT INTO "RemoteFile"("ResourceId", 
+                                        "Purpose", 
+                                        "NameModifier", 
+                                        "Extension") 
+            VALUES (%s, %s, %s, %s)
+        """
+        update_statement = """
+        UPDATE "Games"
+        SET "ScorecardId" = scorecards.resource_id
+        FROM unnest(%s::bigint[], %s::bigint[]) AS scorecards(resource_id, game_id)
+        WHERE "Games"."Id" = scorecards.game_id
+        """
+        rows = [(identifier, game.EndTime, file_name, game.Id, 'Scorecard', 1, False)
+                for game, identifier, file_name in uploaded]
+        with self.connection() as connection:
+            with connection.cursor() as cursor:
+                ids = self.insert_resource_rows(rows, cursor)
+                resource_ids = [ids[identifier] for _, identifier, _ in uploaded]
+                cursor.executemany(file_statement, [(id, 1, None, os.path.splitext(file_name)[1])
+                                                    for id, (_, _, file_name) in zip(resource_ids, uploaded)])
+                cursor.execute(update_statement, (resource_ids, [game.Id for game, _, _ in uploaded]))
+        return [file_name for _, _, file_name in uploaded]
+
+    def get_live_keys(self) -> set[str]:
+        statement = """
+        SELECT UPPER("RemoteResource"."AssetIdentifier"::varchar),
+               "RemoteFile"."Purpose",
+               "RemoteFile"."NameModifier",
+               "RemoteFile"."Extension"
+        FROM "RemoteResource"
+        JOIN "RemoteFile" ON "RemoteResource"."Id" = "RemoteFile"."ResourceId"
+        """
+        with self.connection() as connection:
+            with connection.cursor() as cursor:
+                return {get_key(identifier, FilePurpose(purpose), name_modifier, ext)
+                        for identifier, purpose, name_modifier, ext in cursor.execute(statement)}
+
     def remove_duplicate_thumbnails(self):
         statement = """
             WITH dupes AS (SELECT *
@@ -255,7 +522,10 @@ class DbConnector:
                     UPPER("AssetIdentifier"::varchar) AS Identifier,
                     "Extension",
                     "NameModifier",
-                    ROW_NUMBER() over (PARTITION BY "ResourceId", "NameModifier" ORDER BY "Extension" DESC) as rn
+                    -- the web formats sit alongside a size's JPEG rather than duplicating it
+                    ROW_NUMBER() over (PARTITION BY "ResourceId", "NameModifier",
+                                                    CASE WHEN "Extension" IN ('.webp', '.avif') THEN "Extension" END
+                                       ORDER BY "Extension" DESC) as rn
             FROM "RemoteFile"
             JOIN "RemoteResource" r ON "RemoteFile"."ResourceId" = r."Id"
             WHERE "Purpose" = 2) thumbnails
@@ -265,6 +535,6 @@ class DbConnector:
                 USING dupes
             WHERE dupes."Id" = "RemoteFile"."Id"
         """
-        with psycopg.connect(self.__config.connection_info()) as connection:
+        with self.connection() as connection:
             with connection.cursor() as cursor:
                 cursor.execute(statement)
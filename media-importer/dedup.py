@@ -0,0 +1,146 @@
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from datetime import timedelta
+from PIL import Image, ImageFilter, ImageStat
+from osxphotos import PhotoInfo
+
+from metrics import Metrics
+from path_management import Game, PathManager
+
+def dhash(image: Image.Image, size: int = 8) -> int:
+    # one bit per adjacent pixel pair of a tiny grayscale copy; near-identical frames differ in few bits
+    small = image.convert('L').resize((size + 1, size), Image.Resampling.BILINEAR)
+    pixels = small.tobytes()
+    bits = 0
+    for row in range(size):
+        for col in range(size):
+            i = row * (size + 1) + col
+            bits = bits << 1 | (pixels[i] > pixels[i + 1])
+    return bits
+
+def sharpness(image: Image.Image) -> float:
+    # variance of the edge response, which drops as motion blur or missed focus smear edges
+    return ImageStat.Stat(image.convert('L').filter(ImageFilter.FIND_EDGES)).var[0]
+
+@dataclass
+class Frame:
+    photo: PhotoInfo
+    hash: int | None
+    sharpness: float
+
+    def distance(self, other: 'Frame') -> int | None:
+        if self.hash is None or other.hash is None:
+            return None
+        return (self.hash ^ other.hash).bit_count()
+
+@dataclass
+class DedupReport:
+    game: Game
+    kept: list[PhotoInfo] = field(default_factory=list)
+    collapsed: list[PhotoInfo] = field(default_factory=list)
+    # bursts that lost at least one frame, as (kept, collapsed) frames
+    groups: list[tuple[list[Frame], list[Frame]]] = field(default_factory=list)
+
+    def to_dict(self) -> dict:
+        def describe(frame: Frame) -> dict:
+            return {'uuid': frame.photo.uuid, 'filename': frame.photo.original_filename,
+                    'date': frame.photo.date.isoformat(), 'favorite': bool(frame.photo.favorite),
+                    'sharpness': round(frame.sharpness, 1)}
+        return {
+            'game_id': self.game.Id,
+            'game': self.game.Name,
+            'kept': len(self.kept),
+            'collapsed': len(self.collapsed),
+            'groups': [{'kept': [describe(f) for f in kept], 'collapsed': [describe(f) for f in collapsed]}
+                       for kept, collapsed in self.groups],
+        }
+
+class Deduplicator:
+    # collapsed frames lose their preview, as if rejected by hand during review
+
+    def __init__(self, path_manager: PathManager, max_distance: int = 6, max_gap: timedelta = timedelta(seconds=2),
+                 keep: str = 'favorite', workers: int = 8, decode_size: int = 256, metrics: Metrics | None = None):
+        if keep not in ('favorite', 'sharpest'):
+            raise ValueError(f'unknown keep strategy {keep!r}')
+        self._paths = path_manager
+        self.max_distance = max_distance
+        self.max_gap = max_gap
+        self.keep = keep
+        self.workers = workers
+        # hashes and sharpness are measured on a copy about this size, never the full image
+        self.decode_size = decode_size
+        self.metrics = metrics or Metrics()
+
+    def dedup_game(self, game: Game, photos: list[PhotoInfo], export_paths: dict[str, str]) -> DedupReport:
+        # photos whose preview is already gone were rejected earlier and are left out of kept
+        report = DedupReport(game)
+        preview_dir = self._paths.preview_dir(game)
+        previews = {}
+        for photo in photos:
+            ext = os.path.splitext(export_paths[photo.uuid])[1]
+            path = os.path.join(preview_dir, f'{photo.uuid}{ext}')
+            if os.path.exists(path):
+                previews[photo.uuid] = path
+        candidates = [p for p in photos if p.uuid in previews and not p.ismovie]
+        report.kept = [p for p in photos if p.uuid in previews and p.ismovie]
+
+        with self.metrics.timer('dedup', 'game'):
+            with ThreadPoolExecutor(self.workers) as executor:
+                frames = list(executor.map(lambda p: self.frame(p, previews[p.uuid]), candidates))
+            for group in self.group(frames):
+                kept, collapsed = self.choose(group)
+                report.kept.extend(f.photo for f in kept)
+                report.collapsed.extend(f.photo for f in collapsed)
+                if collapsed:
+                    report.groups.append((kept, collapsed))
+        for photo in report.collapsed:
+            os.remove(previews[photo.uuid])
+        self.metrics.count('dedup', 'frames', len(candidates))
+        self.metrics.count('dedup', 'collapsed', len(report.collapsed))
+        self.write_report(report)
+        return report
+
+    def frame(self, photo: PhotoInfo, path: str) -> Frame:
+        try:
+            with Image.open(path) as image:
+                if image.format == 'JPEG':
+                    image.draft('L', (self.decode_size, self.decode_size))
+                else:
+                    factor = min(image.size) // self.decode_size
+                    image = image.reduce(factor) if factor > 1 else image.copy()
+                return Frame(photo, dhash(image), sharpness(image))
+        except Exception:
+            # unreadable here doesn't mean unusable, so it just can't match anything
+            self.metrics.count('dedup', 'unreadable')
+            return Frame(photo, None, 0.0)
+
+    def group(self, frames: list[Frame]) -> list[list[Frame]]:
+        # a burst can drift, so each frame is compared with the one before it rather than the first
+        groups: list[list[Frame]] = []
+        for frame in sorted(frames, key=lambda f: f.photo.date):
+            if groups:
+                previous = groups[-1][-1]
+                distance = frame.distance(previous)
+                if (frame.photo.date - previous.photo.date <= self.max_gap
+                        and distance is not None and distance <= self.max_distance):
+                    groups[-1].append(frame)
+                    continue
+            groups.append([frame])
+        return groups
+
+    def choose(self, group: list[Frame]) -> tuple[list[Frame], list[Frame]]:
+        favorites = [f for f in group if f.photo.favorite]
+        if self.keep == 'favorite' and favorites:
+            kept = favorites
+        else:
+            kept = [max(group, key=lambda f: f.sharpness)]
+        kept_ids = {id(f) for f in kept}
+        return kept, [f for f in group if id(f) not in kept_ids]
+
+    def write_report(self, report: DedupReport):
+        path = self._paths.dedup_report_path(report.game)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as report_file:
+            json.dump(report.to_dict(), report_file, indent=2)
@@ -0,0 +1,99 @@
+import os
+from enum import IntEnum
+from osxphotos import PhotoInfo
+from path_management import PathManager
+
+class FilePurpose(IntEnum):
+    # values match RemoteFilePurpose in the API
+    UNKNOWN = 0
+    ORIGINAL = 1
+    THUMBNAIL = 2
+    ALTERNATE_FORMAT = 3
+
+    @property
+    def key_name(self) -> str:
+        return _KEY_NAMES[self]
+
+_KEY_NAMES = {
+    # the API names files of unknown purpose with an empty base name
+    FilePurpose.UNKNOWN: '',
+    FilePurpose.ORIGINAL: 'original',
+    FilePurpose.THUMBNAIL: 'thumbnail',
+    FilePurpose.ALTERNATE_FORMAT: 'alt',
+}
+
+def get_file_purpose(name_modifier: str | None, ext: str, ismovie: bool, has_alternate_formats: bool) -> FilePurpose:
+    if ismovie and ext == '.jpeg':
+        return FilePurpose.THUMBNAIL
+    elif name_modifier is not None:
+        return FilePurpose.THUMBNAIL
+    elif has_alternate_formats and ext == '.jpeg':
+        return FilePurpose.ALTERNATE_FORMAT
+    else:
+        return FilePurpose.ORIGINAL
+
+def get_key(photo_uuid: str, purpose: FilePurpose, name_modifier: str | None, ext: str) -> str:
+    base = purpose.key_name
+    if name_modifier:
+        base = f'{base}_{name_modifier}'
+    return f'{photo_uuid}/{base}{ext}'
+
+class ManifestEntry:
+    __slots__ = ('name', 'path', 'purpose', 'name_modifier', 'ext', 'size', 'key', 'data')
+
+    def __init__(self, name: str, path: str, purpose: FilePurpose, name_modifier: str | None, ext: str,
+                 size: int, key: str, data: bytes | None = None):
+        self.name = name
+        self.path = path
+        self.purpose = purpose
+        self.name_modifier = name_modifier
+        self.ext = ext
+        self.size = size
+        self.key = key
+        # contents of files that only exist in memory
+        self.data = data
+
+    def __repr__(self) -> str:
+        return f'ManifestEntry({self.key!r}, {self.purpose.name}, {self.size})'
+
+class FileManifest:
+    # classified once, so the uploader and the database importer agree on purposes and keys
+    __slots__ = ('photo_uuid', 'root_path', 'entries')
+
+    def __init__(self, photo_uuid: str, root_path: str, entries: list[ManifestEntry]):
+        self.photo_uuid = photo_uuid
+        self.root_path = root_path
+        self.entries = entries
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    @classmethod
+    def scan(cls, root_path: str, photo: PhotoInfo, path_manager: PathManager,
+             buffers: dict[str, bytes] | None = None) -> 'FileManifest':
+        # in-memory buffers take precedence over files of the same name on disk
+        buffers = buffers or {}
+        files: dict[str, tuple[int, bytes | None]] = {}
+        with os.scandir(root_path) as scan:
+            for entry in scan:
+                if entry.is_file() and entry.name not in buffers:
+                    files[entry.name] = (entry.stat().st_size, None)
+        for name, data in buffers.items():
+            files[name] = (len(data), data)
+
+        classified = []
+        for name in sorted(files):
+            stem, ext = os.path.splitext(name)
+            classified.append((name, path_manager.get_name_modifier(stem), ext))
+        has_alternate_formats = sum(1 for _, name_modifier, _ in classified if name_modifier is None) > 1
+
+        entries = []
+        for name, name_modifier, ext in classified:
+            purpose = get_file_purpose(name_modifier, ext, photo.ismovie, has_alternate_formats)
+            size, data = files[name]
+            entries.append(ManifestEntry(name, os.path.join(root_path, name), purpose, name_modifier, ext,
+                                         size, get_key(photo.uuid, purpose, name_modifier, ext), data))
+        return cls(photo.uuid, root_path, entries)
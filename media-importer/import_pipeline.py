@@ -0,0 +1,281 @@
+import argparse
+import os
+import queue
+import shutil
+import threading
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import date
+from osxphotos import PhotoInfo
+
+from bucket_connect import BucketConfig, BucketConnector
+from db_connect import DbConnector, PostgresConfig
+from dedup import Deduplicator
+from file_manifest import FileManifest
+from journal import ImportJournal, Stage
+from metrics import Metrics
+from path_management import Game, PathManager
+from photo_export import PhotoExporter
+from thumbnail_cache import ThumbnailCache
+from thumbnails import WEB_FORMATS, MemoryBudget, ThumbnailDef, ThumbnailParams, Thumbnailer, with_formats
+
+SIZES = [ThumbnailDef(120, 'small'), ThumbnailDef(400, 'medium'), ThumbnailDef(1600, 'large')]
+
+# marks the end of a stage's input
+_DONE = None
+
+@dataclass
+class PipelineItem:
+    game: Game
+    photo: PhotoInfo
+    error: Exception | None = None
+    # in-memory mode: encoded thumbnails by file name
+    buffers: dict[str, bytes] | None = None
+    # the photo's files, scanned once for both the upload and the database import
+    manifest: FileManifest | None = None
+
+class ImportPipeline:
+    # export, thumbnail, upload and record run as overlapping stages connected by bounded queues
+
+    def __init__(self, exporter: PhotoExporter, thumbnailer: Thumbnailer, bucket: BucketConnector, db: DbConnector,
+                 paths: PathManager, overwrite: bool = False, thumbnail_workers: int = os.cpu_count(),
+                 upload_workers: int = 8, queue_size: int = 64, record_batch_size: int = 100, flush_seconds: float = 5.0,
+                 in_memory: bool = False, deduplicator: Deduplicator | None = None, journal: ImportJournal | None = None):
+        self._exporter = exporter
+        self._thumbnailer = thumbnailer
+        self._bucket = bucket
+        self._db = db
+        self._paths = paths
+        self._overwrite = overwrite
+        self._thumbnail_workers = thumbnail_workers
+        self._upload_workers = upload_workers
+        self._record_batch_size = record_batch_size
+        self._flush_seconds = flush_seconds
+        self._in_memory = in_memory
+        self._deduplicator = deduplicator
+        self._journal = journal
+        self._thumbnail_queue: queue.Queue[PipelineItem | None] = queue.Queue(queue_size)
+        self._upload_queue: queue.Queue[PipelineItem | None] = queue.Queue(queue_size)
+        self._record_queue: queue.Queue[PipelineItem | None] = queue.Queue(queue_size)
+        self.errors: list[PipelineItem] = []
+        self._errors_lock = threading.Lock()
+        self._memory_budget = MemoryBudget(thumbnailer.memory_budget)
+
+    def run(self, games: list[Game]):
+        self._exporter.assign_photos_to_games(games)
+        with ProcessPoolExecutor(self._thumbnail_workers) as pool, ThreadPoolExecutor(self._upload_workers) as uploads:
+            thumbnail_threads = self._start(self.thumbnail_worker, self._thumbnail_workers, pool)
+            upload_threads = self._start(self.upload_worker, self._upload_workers, uploads)
+            record_threads = self._start(self.record_worker, 1)
+
+            self.export(games)
+            self._finish(self._thumbnail_queue, thumbnail_threads)
+            self._finish(self._upload_queue, upload_threads)
+            self._finish(self._record_queue, record_threads)
+        if self._thumbnailer.cache:
+            self._thumbnailer.cache.evict()
+
+        for item in self.errors:
+            print('Error: ', item.game.Name, item.photo.uuid, item.error)
+
+    def _start(self, target, count: int, *args) -> list[threading.Thread]:
+        threads = [threading.Thread(target=target, args=args, daemon=True) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        return threads
+
+    def _finish(self, stage_queue: queue.Queue, threads: list[threading.Thread]):
+        for _ in threads:
+            stage_queue.put(_DONE)
+        for thread in threads:
+            thread.join()
+
+    def _fail(self, item: PipelineItem, error: Exception):
+        item.error = error
+        with self._errors_lock:
+            self.errors.append(item)
+
+    def export(self, games: list[Game]):
+        items = [(photo, game) for game in games for photo in self._exporter.get_photos_for_game(game)]
+        remaining = Counter(game.Id for _, game in items)
+        exported: dict[int, list[PhotoInfo]] = {}
+        for photo, game, error in self._exporter.export_many(items):
+            if error:
+                self._fail(PipelineItem(game, photo), error)
+            elif photo.uuid in self._exporter.export_paths:
+                if self._deduplicator is None:
+                    self._thumbnail_queue.put(PipelineItem(game, photo))
+                else:
+                    exported.setdefault(game.Id, []).append(photo)
+            remaining[game.Id] -= 1
+            if self._deduplicator is not None and remaining[game.Id] == 0:
+                for photo in self.dedup(game, exported.pop(game.Id, [])):
+                    self._thumbnail_queue.put(PipelineItem(game, photo))
+
+    def dedup(self, game: Game, photos: list[PhotoInfo]) -> list[PhotoInfo]:
+        try:
+            report = self._deduplicator.dedup_game(game, photos, self._exporter.export_paths)
+        except Exception as e:
+            # losing the dedup only costs some extra work, so import everything instead
+            print('Error: deduplicating', game.Name, e)
+            return photos
+        if report.collapsed:
+            print(f'{game.Name}: collapsed {len(report.collapsed)} of {len(photos)} photos')
+        return report.kept
+
+    def thumbnail_worker(self, pool: ProcessPoolExecutor):
+        while (item := self._thumbnail_queue.get()) is not _DONE:
+            try:
+                params = ThumbnailParams(self._exporter.export_paths[item.photo.uuid], item.photo.ismovie,
+                                         item.photo.uuid, item.game.Id)
+                if self._in_memory:
+                    # nothing downstream needs the thumbnails again once the photo is uploaded and recorded
+                    if not self.is_imported(item):
+                        item.buffers = self._submit(pool, 'thumbnail_to_memory', params)
+                elif not self._thumbnailer.is_journaled(params):
+                    # thumbnail returns rather than raises its errors
+                    error = self._submit(pool, 'thumbnail', params)
+                    if error:
+                        raise error
+                    self._thumbnailer.record(params)
+            except Exception as e:
+                self._fail(item, e)
+            else:
+                self._upload_queue.put(item)
+
+    def is_imported(self, item: PipelineItem) -> bool:
+        return self._journal is not None and all(self._journal.is_done(item.photo.uuid, item.game.Id, stage)
+                                                 for stage in (Stage.UPLOADED, Stage.RECORDED))
+
+    def _submit(self, pool: ProcessPoolExecutor, method: str, params: ThumbnailParams):
+        # wait until the job's estimated decode memory fits alongside the running ones
+        estimate = self._thumbnailer.estimate_memory(params)
+        self._memory_budget.acquire(estimate)
+        try:
+            result, error, snapshot = pool.submit(self._thumbnailer.measured, method, params).result()
+        finally:
+            self._memory_budget.release(estimate)
+        self._thumbnailer.metrics.merge(snapshot)
+        if error:
+            raise error
+        return result
+
+    def upload_worker(self, uploads: ThreadPoolExecutor):
+        while (item := self._upload_queue.get()) is not _DONE:
+            try:
+                root_path = self._paths.temp_dir(item.game, item.photo)
+                item.manifest = FileManifest.scan(root_path, item.photo, self._paths, item.buffers)
+                item.buffers = None
+                params = self._bucket.get_upload_params(item.manifest, self._overwrite, item.game.Id)
+                results = self._bucket.upload_many_files(params, executor=uploads)
+                # the database only needs the names, so let go of in-memory contents
+                for entry in item.manifest:
+                    entry.data = None
+                errors = [r.error for r in results if r.error]
+                if errors:
+                    raise errors[0]
+            except Exception as e:
+                self._fail(item, e)
+            else:
+                self._record_queue.put(item)
+
+    def record_worker(self):
+        # batch database writes per game so each flush is a single bulk import
+        pending: dict[int, tuple[Game, list[PipelineItem]]] = {}
+        count = 0
+        while True:
+            try:
+                item = self._record_queue.get(timeout=self._flush_seconds)
+            except queue.Empty:
+                self._flush_records(pending)
+                count = 0
+                continue
+            if item is _DONE:
+                self._flush_records(pending)
+                return
+            pending.setdefault(item.game.Id, (item.game, []))[1].append(item)
+            count += 1
+            if count >= self._record_batch_size:
+                self._flush_records(pending)
+                count = 0
+
+    def _flush_records(self, pending: dict[int, tuple[Game, list[PipelineItem]]]):
+        for game, items in pending.values():
+            manifests = {item.photo.uuid: item.manifest for item in items if item.manifest is not None}
+            try:
+                self._db.import_resources(game, [item.photo for item in items], manifests=manifests)
+            except Exception as e:
+                for item in items:
+                    self._fail(item, e)
+        pending.clear()
+
+def main():
+    parser = argparse.ArgumentParser(description='Export, thumbnail, upload and import the photos for a range of games.')
+    parser.add_argument('from_date', type=date.fromisoformat)
+    parser.add_argument('to_date', type=date.fromisoformat, nargs='?')
+    parser.add_argument('--postgres-config', default='./prod.postgres_config')
+    parser.add_argument('--bucket-config', default='./prod.bucket_config')
+    parser.add_argument('--overwrite', action='store_true', help='upload every file even when the bucket already has an identical copy')
+    parser.add_argument('--hours-before', type=int, default=3)
+    parser.add_argument('--hours-after', type=int, default=2)
+    parser.add_argument('--export-workers', type=int, default=8,
+                        help='threads for journal checks and previews; the exports themselves run one at a time')
+    parser.add_argument('--thumbnail-workers', type=int, default=os.cpu_count())
+    parser.add_argument('--upload-workers', type=int, default=8, help='files uploaded at once, across all photos')
+    parser.add_argument('--queue-size', type=int, default=64)
+    parser.add_argument('--memory-budget-gb', type=float, default=None,
+                        help='estimated memory thumbnail workers may use at once, defaults to half of physical memory')
+    parser.add_argument('--cache-gb', type=float, default=5, help='size of the thumbnail cache, 0 to disable it')
+    parser.add_argument('--fast', action='store_true',
+                        help='decode photos near thumbnail size and resample small sizes bilinearly')
+    parser.add_argument('--formats', default=None,
+                        help=f'comma separated thumbnail formats for every size, from {", ".join(WEB_FORMATS)}; plain JPEG by default. '
+                             'The API serves avif, then webp, then jpeg')
+    parser.add_argument('--dedup', action='store_true', help='collapse bursts and near-duplicate shots to their best frame')
+    parser.add_argument('--dedup-distance', type=int, default=6, help='largest perceptual hash difference, in bits, for a duplicate')
+    parser.add_argument('--dedup-keep', choices=['favorite', 'sharpest'], default='favorite',
+                        help='favorite keeps every favorite in a group, or the sharpest frame if there are none')
+    parser.add_argument('--in-memory', action='store_true', help='upload thumbnails from memory without writing them to disk')
+    parser.add_argument('--keep-files', action='store_true', help='keep the exported files after importing')
+    parser.add_argument('--metrics-textfile', default=None,
+                        help='where to write the Prometheus textfile, e.g. into node_exporter\'s textfile directory')
+    args = parser.parse_args()
+
+    sizes = with_formats(SIZES, args.formats.split(',')) if args.formats else SIZES
+    paths = PathManager([size.name_modifier for size in sizes])
+    journal = ImportJournal(paths.journal_path(PostgresConfig.load(args.postgres_config).target(),
+                                               BucketConfig.load(args.bucket_config).target()))
+    metrics = Metrics()
+    cache = ThumbnailCache(paths.thumbnail_cache_dir(), int(args.cache_gb * 1024 ** 3)) if args.cache_gb > 0 else None
+    memory_budget = int(args.memory_budget_gb * 1024 ** 3) if args.memory_budget_gb else None
+    thumbnailer = Thumbnailer(sizes, journal, fast=args.fast, cache=cache, workers=args.thumbnail_workers,
+                              memory_budget=memory_budget, metrics=metrics)
+    exporter = PhotoExporter(paths, hours_before=args.hours_before, hours_after=args.hours_after, journal=journal,
+                             metrics=metrics, export_workers=args.export_workers)
+    bucket = BucketConnector(args.bucket_config, paths, journal, metrics)
+    deduplicator = Deduplicator(paths, max_distance=args.dedup_distance, keep=args.dedup_keep, metrics=metrics) if args.dedup else None
+    with DbConnector(args.postgres_config, paths, journal, metrics) as db:
+        games = db.get_games(args.from_date, args.to_date or args.from_date)
+        pipeline = ImportPipeline(exporter, thumbnailer, bucket, db, paths,
+                                  overwrite=args.overwrite,
+                                  thumbnail_workers=args.thumbnail_workers,
+                                  upload_workers=args.upload_workers,
+                                  queue_size=args.queue_size,
+                                  in_memory=args.in_memory,
+                                  deduplicator=deduplicator,
+                                  journal=journal)
+        pipeline.run(games)
+    bucket.write_report(os.path.join(paths.root, 'upload-report.json'))
+    metrics.write_json(os.path.join(paths.root, 'run-metrics.json'))
+    metrics.write_prometheus(args.metrics_textfile or os.path.join(paths.root, 'media_import.prom'))
+
+    if not args.keep_files:
+        for game in games:
+            root_path = paths.base_dir(game)
+            if os.path.exists(root_path):
+                shutil.rmtree(root_path)
+    journal.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+import hashlib
+import os
+import sqlite3
+import threading
+
+class Stage:
+    EXPORTED = 'exported'
+    THUMBNAILED = 'thumbnailed'
+    UPLOADED = 'uploaded'
+    RECORDED = 'recorded'
+
+def file_md5(path: str, chunk_size: int = 1024 * 1024) -> str:
+    digest = hashlib.md5()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class ImportJournal:
+    # stages finished per photo and game, so an interrupted import can resume
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._connect()
+
+    def _connect(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self._connection = sqlite3.connect(self.path, check_same_thread=False)
+        self._connection.executescript("""
+            CREATE TABLE IF NOT EXISTS stage (
+                photo_uuid TEXT NOT NULL,
+                game_id INTEGER NOT NULL,
+                stage TEXT NOT NULL,
+                completed_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                version TEXT,
+                PRIMARY KEY (photo_uuid, game_id, stage)
+            );
+            CREATE TABLE IF NOT EXISTS file (
+                photo_uuid TEXT NOT NULL,
+                game_id INTEGER NOT NULL,
+                stage TEXT NOT NULL,
+                name TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                md5 TEXT,
+                PRIMARY KEY (photo_uuid, game_id, stage, name)
+            );
+        """)
+        columns = {row[1] for row in self._connection.execute('PRAGMA table_info(stage)')}
+        if 'version' not in columns:
+            # journals written before source versions were kept
+            self._connection.execute('ALTER TABLE stage ADD COLUMN version TEXT')
+        # finished stages are kept in memory so lookups during a run are O(1)
+        self._done = set(self._connection.execute('SELECT photo_uuid, game_id, stage FROM stage'))
+
+    # sqlite connections can't be pickled, so worker processes reopen the file
+    def __getstate__(self):
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.path = state['path']
+        self._lock = threading.Lock()
+        self._connect()
+
+    def close(self):
+        self._connection.close()
+
+    def is_done(self, photo_uuid: str, game_id: int, stage: str) -> bool:
+        return (photo_uuid, game_id, stage) in self._done
+
+    def record(self, photo_uuid: str, game_id: int, stage: str, files: dict[str, str | bytes] | None = None, hash_files: bool = True,
+               version: str | None = None):
+        # files maps each name to its local path, or to its contents if it only exists in memory
+        rows = []
+        for name, source in (files or {}).items():
+            if isinstance(source, bytes):
+                size, md5 = len(source), hashlib.md5(source).hexdigest() if hash_files else None
+            else:
+                size, md5 = os.path.getsize(source), file_md5(source) if hash_files else None
+            rows.append((photo_uuid, game_id, stage, name, size, md5))
+        with self._lock:
+            with self._connection:
+                self._connection.execute('DELETE FROM file WHERE photo_uuid = ? AND game_id = ? AND stage = ?',
+                                         (photo_uuid, game_id, stage))
+                self._connection.executemany('INSERT INTO file VALUES (?, ?, ?, ?, ?, ?)', rows)
+                self._connection.execute('INSERT OR REPLACE INTO stage(photo_uuid, game_id, stage, version) VALUES (?, ?, ?, ?)',
+                                         (photo_uuid, game_id, stage, version))
+            self._done.add((photo_uuid, game_id, stage))
+
+    def files(self, photo_uuid: str, game_id: int, stage: str) -> list[tuple[str, int, str | None]]:
+        statement = 'SELECT name, size, md5 FROM file WHERE photo_uuid = ? AND game_id = ? AND stage = ? ORDER BY rowid'
+        with self._lock:
+            return self._connection.execute(statement, (photo_uuid, game_id, stage)).fetchall()
+
+    def version(self, photo_uuid: str, game_id: int, stage: str) -> str | None:
+        statement = 'SELECT version FROM stage WHERE photo_uuid = ? AND game_id = ? AND stage = ?'
+        with self._lock:
+            row = self._connection.execute(statement, (photo_uuid, game_id, stage)).fetchone()
+        return row[0] if row else None
+
+    def reset_photo(self, photo_uuid: str, game_id: int):
+        with self._lock:
+            with self._connection:
+                for table in ('file', 'stage'):
+                    self._connection.execute(f'DELETE FROM {table} WHERE photo_uuid = ? AND game_id = ?', (photo_uuid, game_id))
+            self._done = {d for d in self._done if d[:2] != (photo_uuid, game_id)}
+
+    def reset(self, game_id: int, stage: str | None = None):
+        condition = 'game_id = ?' if stage is None else 'game_id = ? AND stage = ?'
+        params = (game_id,) if stage is None else (game_id, stage)
+        with self._lock:
+            with self._connection:
+                self._connection.execute(f'DELETE FROM file WHERE {condition}', params)
+                self._connection.execute(f'DELETE FROM stage WHERE {condition}', params)
+            self._done = {d for d in self._done if d[1] != game_id or (stage is not None and d[2] != stage)}
@@ -0,0 +1,156 @@
+import json
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+# histogram upper bounds in seconds, from a cache hit to a slow video batch
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, math.inf)
+
+class Timing:
+    __slots__ = ('count', 'total', 'max', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * len(BUCKETS)
+
+    def observe(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.buckets[i] += 1
+                break
+
+    def merge(self, state: tuple):
+        count, total, maximum, buckets = state
+        self.count += count
+        self.total += total
+        self.max = max(self.max, maximum)
+        self.buckets = [a + b for a, b in zip(self.buckets, buckets)]
+
+    def state(self) -> tuple:
+        return self.count, self.total, self.max, list(self.buckets)
+
+    def quantile(self, q: float) -> float | None:
+        # the upper bound of the bucket holding the q-th observation, capped at the slowest call
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.buckets):
+            seen += count
+            if seen >= rank:
+                return round(min(bound, self.max), 4)
+        return round(self.max, 4)
+
+class Metrics:
+    # copies pickled into workers start empty; the parent merges what their drain() hands back
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: dict[tuple[str, str], float] = {}
+        self._timings: dict[tuple[str, str], Timing] = {}
+        self.started_at = datetime.now(timezone.utc)
+        self._start = time.perf_counter()
+
+    def __getstate__(self):
+        return {}
+
+    def __setstate__(self, state):
+        self.__init__()
+
+    def count(self, stage: str, name: str, value: float = 1):
+        with self._lock:
+            self._counters[(stage, name)] = self._counters.get((stage, name), 0) + value
+
+    def observe(self, stage: str, name: str, seconds: float):
+        with self._lock:
+            self._timings.setdefault((stage, name), Timing()).observe(seconds)
+
+    @contextmanager
+    def timer(self, stage: str, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.count(stage, f'{name}_failures')
+            raise
+        finally:
+            self.observe(stage, name, time.perf_counter() - start)
+
+    def drain(self) -> dict:
+        # returns what was recorded so far, and starts over
+        with self._lock:
+            snapshot = {'counters': self._counters,
+                        'timings': {key: timing.state() for key, timing in self._timings.items()}}
+            self._counters = {}
+            self._timings = {}
+        return snapshot
+
+    def merge(self, snapshot: dict):
+        with self._lock:
+            for key, value in snapshot['counters'].items():
+                self._counters[key] = self._counters.get(key, 0) + value
+            for key, state in snapshot['timings'].items():
+                self._timings.setdefault(key, Timing()).merge(state)
+
+    def report(self) -> dict:
+        stages: dict[str, dict] = {}
+        with self._lock:
+            for (stage, name), value in sorted(self._counters.items()):
+                stages.setdefault(stage, {'counters': {}, 'timings': {}})['counters'][name] = value
+            for (stage, name), timing in sorted(self._timings.items()):
+                stages.setdefault(stage, {'counters': {}, 'timings': {}})['timings'][name] = {
+                    'calls': timing.count,
+                    'seconds': round(timing.total, 3),
+                    'mean_seconds': round(timing.total / timing.count, 4) if timing.count else None,
+                    'p50_seconds': timing.quantile(0.5),
+                    'p95_seconds': timing.quantile(0.95),
+                    'max_seconds': round(timing.max, 4),
+                }
+        return {'started_at': self.started_at.isoformat(),
+                'elapsed_seconds': round(time.perf_counter() - self._start, 3),
+                'stages': stages}
+
+    def write_json(self, path: str):
+        with open(path, 'w') as report_file:
+            json.dump(self.report(), report_file, indent=2)
+
+    def write_prometheus(self, path: str, prefix: str = 'media_import'):
+        # for node_exporter's textfile collector
+        lines = [f'# TYPE {prefix}_last_run_timestamp_seconds gauge',
+                 f'{prefix}_last_run_timestamp_seconds {self.started_at.timestamp():.0f}',
+                 f'# TYPE {prefix}_run_seconds gauge',
+                 f'{prefix}_run_seconds {time.perf_counter() - self._start:.3f}']
+        with self._lock:
+            counters = sorted(self._counters.items())
+            timings = sorted((key, timing.state()) for key, timing in self._timings.items())
+        for name in sorted({name for (_, name), _ in counters}):
+            lines.append(f'# TYPE {prefix}_{name}_total counter')
+            for (stage, counter_name), value in counters:
+                if counter_name == name:
+                    # byte counts outgrow the precision of a float's default format
+                    value = int(value) if value == int(value) else value
+                    lines.append(f'{prefix}_{name}_total{{stage="{stage}"}} {value}')
+        if timings:
+            lines.append(f'# TYPE {prefix}_call_seconds histogram')
+        for (stage, name), (count, total, _, buckets) in timings:
+            labels = f'stage="{stage}",call="{name}"'
+            cumulative = 0
+            for bound, bucket in zip(BUCKETS, buckets):
+                cumulative += bucket
+                le = '+Inf' if bound == math.inf else f'{bound:g}'
+                lines.append(f'{prefix}_call_seconds_bucket{{{labels},le="{le}"}} {cumulative}')
+            lines.append(f'{prefix}_call_seconds_sum{{{labels}}} {total:.6f}')
+            lines.append(f'{prefix}_call_seconds_count{{{labels}}} {count}')
+        # the collector may read at any time, so never let it see a half written file
+        staging = f'{path}.{os.getpid()}.tmp'
+        with open(staging, 'w') as textfile:
+            textfile.write('\n'.join(lines) + '\n')
+        os.replace(staging, path)
@@ -1,4 +1,5 @@
 import os
+import re
 from dataclasses import dataclass
 from datetime import date, datetime
 from osxphotos import PhotoInfo
@@ -25,15 +26,27 @@ class PathManager:
     def temp_dir(self, game: Game, photo: PhotoInfo) -> str:
         base_dir = self.base_dir(game)
         out_dir = os.path.join(base_dir, photo.uuid)
-        if not os.path.exists(out_dir):
-            os.makedirs(out_dir)
+        # photos are exported from several threads at once
+        os.makedirs(out_dir, exist_ok=True)
         return out_dir
 
+    def journal_path(self, *targets: str) -> str:
+        # uploads and rows recorded for one database and bucket say nothing about another
+        name = re.sub(r'[^A-Za-z0-9.-]+', '_', '-'.join(targets)).strip('_')
+        return os.path.join(self.root, f'journal-{name}.sqlite' if name else 'journal.sqlite')
+
+    def dedup_report_path(self, game: Game) -> str:
+        # outside the game's directory, which is deleted once the import is done
+        safe_name = game.Name.replace(os.path.sep, '_')
+        return os.path.join(self.root, 'dedup', f'{safe_name}.json')
+
+    def thumbnail_cache_dir(self) -> str:
+        return os.path.join(self.root, 'thumbnail-cache')
+
     def preview_dir(self, game: Game) -> str:
         base_dir = self.base_dir(game)
         out_dir = os.path.join(base_dir, 'preview')
-        if not os.path.exists(out_dir):
-            os.makedirs(out_dir)
+        os.makedirs(out_dir, exist_ok=True)
         return out_dir
     
     def get_name_modifier(self, name: str) -> str:
@@ -1,24 +1,51 @@
 from db_connect import Game
 import os
+import threading
 import osxphotos
 from osxphotos import PhotoInfo
-from datetime import timedelta
+from datetime import datetime, timedelta
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Iterator
+import heapq
 from thumbnails import ThumbnailParams
+from thumbnail_cache import link_or_copy
 from path_management import PathManager
+from journal import ImportJournal, Stage
+from metrics import Metrics
 
 class PhotoExporter:
 
-    def __init__(self, path_manager: PathManager, hours_before: int = 3, hours_after: int = 2):
+    def __init__(self, path_manager: PathManager, hours_before: int = 3, hours_after: int = 2, journal: ImportJournal | None = None,
+                 photosdb: osxphotos.PhotosDB | None = None, metrics: Metrics | None = None, export_workers: int = 8):
         self._paths = path_manager
-        self.photosdb = osxphotos.PhotosDB()
+        self._journal = journal
+        # anything with a photos() method will do, e.g. a synthetic library for benchmarks
+        self.photosdb = photosdb or osxphotos.PhotosDB()
+        self.metrics = metrics or Metrics()
+        self.export_workers = export_workers
+        # osxphotos is not thread safe, so every library read and export holds this
+        self._library_lock = threading.Lock()
         self.export_paths = dict()
         self._hours_before = hours_before
         self._hours_after = hours_after
+        # every photo in the library sorted by date, built on first use
+        self._photo_index: list[PhotoInfo] | None = None
+        self._photo_dates: list[datetime] = []
+        self._game_photos: dict[int, list[PhotoInfo]] = dict()
 
-    def export_photos_for_game(self, game: Game) -> str:
-        photos = self.get_photos_for_game(game)
-        for p in photos:
-            self.export(p, game)
+    def export_photos_for_game(self, game: Game):
+        for photo, _, error in self.export_many([(p, game) for p in self.get_photos_for_game(game)]):
+            if error:
+                print('Error: ', game.Name, photo.uuid, error)
+
+    def export_many(self, items: list[tuple[PhotoInfo, Game]]) -> Iterator[tuple[PhotoInfo, Game, Exception | None]]:
+        # the exports themselves still run one at a time under the library lock
+        with ThreadPoolExecutor(self.export_workers) as executor:
+            futures = {executor.submit(self.export, photo, game): (photo, game) for photo, game in items}
+            for future in as_completed(futures):
+                photo, game = futures[future]
+                yield photo, game, future.exception()
 
     def get_exported_photos_for_game(self, game: Game) -> list[PhotoInfo]:
         return [p for p in self.get_photos_for_game(game) if p.uuid in self.export_paths]
@@ -38,7 +65,7 @@ class PhotoExporter:
             ext = os.path.splitext(export_path)[1]
             preview_name = f'{photo.uuid}{ext}'
             if preview_name in remaining_previews:
-                to_thumbnail.append(ThumbnailParams(export_path, photo.ismovie))
+                to_thumbnail.append(ThumbnailParams(export_path, photo.ismovie, photo.uuid, game.Id))
         
         return to_thumbnail
     
@@ -61,23 +88,90 @@ class PhotoExporter:
         return to_upload
 
     def get_photos_for_game(self, game: Game) -> list[PhotoInfo]:
+        if game.Id not in self._game_photos:
+            photos, dates = self.photo_index()
+            start_time, end_time = self.game_window(game)
+            self._game_photos[game.Id] = photos[bisect_left(dates, start_time):bisect_left(dates, end_time)]
+        return self._game_photos[game.Id]
+
+    def game_window(self, game: Game) -> tuple[datetime, datetime]:
         start_time = game.StartTime + timedelta(hours=-self._hours_before)
         end_time = game.EndTime + timedelta(hours=self._hours_after)
-        return self.photosdb.photos(from_date=start_time, to_date=end_time)
+        return start_time, end_time
+
+    def photo_index(self) -> tuple[list[PhotoInfo], list[datetime]]:
+        if self._photo_index is None:
+            photos = sorted((p for p in self.photosdb.photos() if p.date is not None), key=lambda p: p.date)
+            self._photo_index = photos
+            self._photo_dates = [p.date for p in photos]
+        return self._photo_index, self._photo_dates
+
+    def assign_photos_to_games(self, games: list[Game]) -> dict[int, list[PhotoInfo]]:
+        # a photo in overlapping windows (doubleheaders) belongs to each game
+        photos, dates = self.photo_index()
+        windows = sorted(self.game_window(g) + (g.Id,) for g in games)
+        assigned: dict[int, list[PhotoInfo]] = {g.Id: [] for g in games}
+        if len(windows) == 0:
+            return assigned
+
+        active: list[tuple[datetime, int]] = [] # heap of (window end, game id)
+        next_window = 0
+        for i in range(bisect_left(dates, windows[0][0]), len(photos)):
+            date = dates[i]
+            while next_window < len(windows) and windows[next_window][0] <= date:
+                _, end_time, game_id = windows[next_window]
+                heapq.heappush(active, (end_time, game_id))
+                next_window += 1
+            while active and active[0][0] <= date:
+                heapq.heappop(active)
+            if not active and next_window == len(windows):
+                break
+            for _, game_id in active:
+                assigned[game_id].append(photos[i])
+
+        self._game_photos.update(assigned)
+        return assigned
     
     def export(self, photo: PhotoInfo, game: Game):
-        if photo.ismissing:
+        with self._library_lock:
+            missing = photo.ismissing
+            version = self.source_version(photo)
+        if missing:
             print(f'skipping missing photo {photo.filename}')
+            self.metrics.count('export', 'missing')
             return
         
+        if self._journal and self._journal.is_done(photo.uuid, game.Id, Stage.EXPORTED):
+            recorded = self._journal.version(photo.uuid, game.Id, Stage.EXPORTED)
+            # journals from before versions were kept can't tell, so trust them
+            if recorded is not None and recorded != version:
+                # edited since it was exported, so every later stage has to be redone too
+                self._journal.reset_photo(photo.uuid, game.Id)
+                self.metrics.count('export', 'changed')
+            else:
+                paths = [name for name, _, _ in self._journal.files(photo.uuid, game.Id, Stage.EXPORTED)]
+                if len(paths) > 0 and all(os.path.exists(p) for p in paths):
+                    self.export_paths[photo.uuid] = paths[0]
+                    self.metrics.count('export', 'restored')
+                    return
+
         out_dir = self._paths.temp_dir(game, photo)
-        edited = photo.hasadjustments
-        paths = photo.export(out_dir, edited=edited, live_photo=True, export_as_hardlink=True, overwrite=True)
+        with self._library_lock, self.metrics.timer('export', 'export'):
+            paths = photo.export(out_dir, edited=photo.hasadjustments, live_photo=True, export_as_hardlink=True, overwrite=True)
         if len(paths) == 0:
             print(f'export issue with {photo}')
+            self.metrics.count('export', 'failures')
         else:
             self.export_paths[photo.uuid] = paths[0]
             ext = os.path.splitext(paths[0])[1]
-            preview_dir = self._paths.preview_dir(game)
-            photo.export(preview_dir, edited=edited, filename=f'{photo.uuid}{ext}', live_photo=False, export_as_hardlink=True, overwrite=True)
-            
\ No newline at end of file
+            # the preview is only a marker for review, so link the export rather than exporting again
+            link_or_copy(paths[0], os.path.join(self._paths.preview_dir(game), f'{photo.uuid}{ext}'))
+            self.metrics.count('export', 'exported')
+            self.metrics.count('export', 'bytes', sum(os.path.getsize(p) for p in paths))
+            if self._journal:
+                self._journal.record(photo.uuid, game.Id, Stage.EXPORTED, {path: path for path in paths}, version=version)
+
+    def source_version(self, photo: PhotoInfo) -> str:
+        # Photos bumps the modification date whenever an asset or its edits change
+        modified = photo.date_modified
+        return modified.isoformat() if modified else ''
@@ -0,0 +1,43 @@
+import io
+import os
+
+import pytest
+from PIL import Image, ImageCms
+
+from thumbnail_cache import ThumbnailCache
+from thumbnails import ThumbnailDef, ThumbnailParams, Thumbnailer, with_formats
+
+ICC_PROFILE = ImageCms.ImageCmsProfile(ImageCms.createProfile('sRGB')).tobytes()
+
+@pytest.mark.parametrize('fast', [False, True])
+@pytest.mark.parametrize('ext', ['.jpeg', '.png'])
+def test_icc_profile_kept_in_every_format(tmp_path, ext, fast):
+    source = tmp_path / f'IMG{ext}'
+    Image.new('RGB', (800, 600), 'red').save(source, icc_profile=ICC_PROFILE)
+    thumbnailer = Thumbnailer(with_formats([ThumbnailDef(200, 'small')], ['jpeg', 'webp', 'avif']), fast=fast)
+
+    assert thumbnailer.render_photo(str(source)) is None
+    outputs = ['IMG_small.jpeg', 'IMG_small.webp', 'IMG_small.avif'] + (['IMG.jpeg'] if ext != '.jpeg' else [])
+    for name in outputs:
+        with Image.open(tmp_path / name) as image:
+            assert image.info.get('icc_profile') == ICC_PROFILE, name
+
+def test_icc_profile_kept_in_memory(tmp_path):
+    source = tmp_path / 'IMG.png'
+    Image.new('RGB', (800, 600), 'red').save(source, icc_profile=ICC_PROFILE)
+    thumbnailer = Thumbnailer(with_formats([ThumbnailDef(200, 'small')], ['jpeg', 'webp', 'avif']))
+
+    for name, data in thumbnailer.thumbnail_to_memory(ThumbnailParams(str(source), False)).items():
+        with Image.open(io.BytesIO(data)) as image:
+            assert image.info.get('icc_profile') == ICC_PROFILE, name
+
+def test_cache_miss_keeps_current_alternate(tmp_path):
+    source = tmp_path / 'IMG.png'
+    Image.new('RGB', (800, 600), 'red').save(source)
+    cache = ThumbnailCache(str(tmp_path / 'cache'))
+    alternate = tmp_path / 'IMG.jpeg'
+
+    assert Thumbnailer([ThumbnailDef(200, 'small')], fast=True, cache=cache).thumbnail_photo(str(source)) is None
+    modified = os.stat(alternate).st_mtime_ns
+    assert Thumbnailer([ThumbnailDef(100, 'small')], fast=True, cache=cache).thumbnail_photo(str(source)) is None
+    assert os.stat(alternate).st_mtime_ns == modified
@@ -0,0 +1,102 @@
+import hashlib
+import os
+import shutil
+import uuid
+
+def file_sha256(path: str, chunk_size: int = 1024 * 1024) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def link_or_copy(source: str, destination: str):
+    # hardlinks cost nothing, but need source and destination on the same volume
+    if os.path.exists(destination):
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
+
+class ThumbnailCache:
+    # entries are keyed by the source's hash and the settings, and evicted least recently used first
+
+    def __init__(self, root: str, max_bytes: int = 5 * 1024 ** 3):
+        self.root = root
+        self.max_bytes = max_bytes
+        if not os.path.exists(root):
+            os.makedirs(root)
+
+    def key(self, source_path: str, settings: str) -> str:
+        settings_hash = hashlib.sha256(settings.encode()).hexdigest()[:16]
+        return f'{file_sha256(source_path)}-{settings_hash}'
+
+    def entry_dir(self, key: str) -> str:
+        return os.path.join(self.root, key[:2], key)
+
+    def restore(self, key: str, outputs: dict[str, str]) -> bool:
+        # False, without touching the outputs, if the entry is missing or incomplete
+        entry = self.entry_dir(key)
+        if not all(os.path.exists(os.path.join(entry, suffix)) for suffix in outputs):
+            return False
+        for suffix, path in outputs.items():
+            link_or_copy(os.path.join(entry, suffix), path)
+        # the directory's mtime doubles as its last-used time for eviction
+        os.utime(entry)
+        return True
+
+    def load(self, key: str, suffixes: list[str]) -> dict[str, bytes] | None:
+        entry = self.entry_dir(key)
+        if not all(os.path.exists(os.path.join(entry, suffix)) for suffix in suffixes):
+            return None
+        files = {}
+        for suffix in suffixes:
+            with open(os.path.join(entry, suffix), 'rb') as file:
+                files[suffix] = file.read()
+        os.utime(entry)
+        return files
+
+    def store(self, key: str, outputs: dict[str, str]):
+        def link(staging: str):
+            for suffix, path in outputs.items():
+                link_or_copy(path, os.path.join(staging, suffix))
+        self._store(key, link)
+
+    def store_data(self, key: str, files: dict[str, bytes]):
+        def write(staging: str):
+            for suffix, data in files.items():
+                with open(os.path.join(staging, suffix), 'wb') as file:
+                    file.write(data)
+        self._store(key, write)
+
+    def _store(self, key: str, fill):
+        entry = self.entry_dir(key)
+        if os.path.exists(entry):
+            return
+        # build the entry under a temporary name so other workers never see half of it
+        staging = os.path.join(self.root, f'.staging-{uuid.uuid4().hex}')
+        os.makedirs(staging)
+        fill(staging)
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        try:
+            os.rename(staging, entry)
+        except OSError:
+            # another worker stored the same entry first
+            shutil.rmtree(staging, ignore_errors=True)
+
+    def evict(self):
+        entries = []
+        total = 0
+        for shard in os.scandir(self.root):
+            if not shard.is_dir() or shard.name.startswith('.staging-'):
+                continue
+            for entry in os.scandir(shard.path):
+                size = sum(f.stat().st_size for f in os.scandir(entry.path))
+                entries.append((entry.stat().st_mtime, size, entry.path))
+                total += size
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
@@ -1,34 +1,323 @@
+import io
 import os
-from dataclasses import dataclass
+import shutil
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from typing import Iterator
 from PIL import Image, ImageOps
 import subprocess
-from multiprocessing import Pool
 from pillow_heif import register_heif_opener
+from journal import ImportJournal, Stage
+from metrics import Metrics
+from thumbnail_cache import ThumbnailCache
 register_heif_opener()
+# AVIF is built into Pillow from 11.2; older versions can get it from pillow_heif
+if '.avif' not in Image.registered_extensions():
+    try:
+        from pillow_heif import register_avif_opener
+        register_avif_opener()
+    except ImportError:
+        pass
+
+@dataclass
+class ThumbnailFormat:
+    # one file per format of a size, e.g. _small.jpeg and _small.webp
+    ext: str = '.jpeg'
+    # None leaves the encoder's default
+    quality: int | None = None
+    # JPEG only
+    progressive: bool = False
+    optimize: bool = False
+    # drop EXIF and XMP (camera details, location), but never the ICC profile
+    strip_metadata: bool = True
+    # any other encoder arguments, passed to Image.save as is
+    options: dict = field(default_factory=dict)
+
+    def save_options(self, image: Image.Image) -> dict:
+        options = {'format': Image.registered_extensions()[self.ext]}
+        # the encoders only write a profile when given one; wide gamut photos shift colour without it
+        if image.info.get('icc_profile'):
+            options['icc_profile'] = image.info['icc_profile']
+        if self.quality is not None:
+            options['quality'] = self.quality
+        if options['format'] == 'JPEG':
+            options['progressive'] = self.progressive
+            options['optimize'] = self.optimize
+        if self.strip_metadata:
+            options['exif'] = b''
+            options['xmp'] = b''
+        options.update(self.options)
+        return options
+
+    def settings(self) -> str:
+        return f'{self.ext}:{self.quality}:{self.progressive}:{self.optimize}:{self.strip_metadata}:{sorted(self.options.items())}'
+
+# the full size frame of a video and the JPEG copy of a photo that isn't one
+ALT_FORMAT = ThumbnailFormat('.jpeg')
+
+# formats tuned for the website, by name
+WEB_FORMATS = {
+    'jpeg': ThumbnailFormat('.jpeg', quality=82, progressive=True, optimize=True),
+    'webp': ThumbnailFormat('.webp', quality=80),
+    # the encoder's default speed is several times slower than the rest of the thumbnailing
+    'avif': ThumbnailFormat('.avif', quality=60, options={'speed': 8}),
+}
 
 @dataclass
 class ThumbnailDef:
     max_size: int
     name_modifier: str
+    formats: list[ThumbnailFormat] = field(default_factory=lambda: [ThumbnailFormat()])
+
+def with_formats(sizes: list[ThumbnailDef], formats: list[str]) -> list[ThumbnailDef]:
+    # the API serves avif, then webp, then jpeg
+    return [ThumbnailDef(size.max_size, size.name_modifier, [WEB_FORMATS[f] for f in formats]) for size in sizes]
 
 @dataclass
 class ThumbnailParams:
     path: str
     ismovie: bool
+    # identify the photo in the import journal, when one is used
+    photo_uuid: str | None = None
+    game_id: int | None = None
+
+def default_memory_budget() -> int:
+    # half of physical memory
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // 2
+
+class MemoryBudget:
+    # a job that is alone still runs, even if it is over budget
+
+    def __init__(self, budget: int):
+        self.budget = budget
+        self.used = 0
+        self._condition = threading.Condition()
+
+    def try_acquire(self, amount: int) -> bool:
+        with self._condition:
+            if self.used > 0 and self.used + amount > self.budget:
+                return False
+            self.used += amount
+            return True
+
+    def acquire(self, amount: int):
+        with self._condition:
+            self._condition.wait_for(lambda: self.used == 0 or self.used + amount <= self.budget)
+            self.used += amount
+
+    def release(self, amount: int):
+        with self._condition:
+            self.used -= amount
+            self._condition.notify_all()
+
+@dataclass
+class ThumbnailJob:
+    params: list[ThumbnailParams]
+    estimate: int
+    # the Thumbnailer method to call with argument
+    method: str
+    argument: object
 
 class Thumbnailer:
 
-    def __init__(self, sizes: list[ThumbnailDef]):
+    def __init__(self, sizes: list[ThumbnailDef], journal: ImportJournal | None = None, 
+                 fast: bool = False, fast_resample_max_size: int = 400, video_batch_size: int = 4,
+                 cache: ThumbnailCache | None = None, workers: int = os.cpu_count(), memory_budget: int | None = None,
+                 metrics: Metrics | None = None):
         # sizes will be computed sequentially, so order from large to small
         self.sizes = sorted(sizes, key=lambda s: s.max_size, reverse=True)
         self.name_modifiers = [size.name_modifier for size in sizes]
+        self._journal = journal
+        # decode near the largest thumbnail size instead of at full resolution when possible
+        self.fast = fast
+        # sizes at or below this are resampled with a cheaper filter in fast mode
+        self.fast_resample_max_size = fast_resample_max_size
+        # number of videos whose frames are extracted by a single ffmpeg process
+        self.video_batch_size = video_batch_size
+        self.cache = cache
+        # jobs are only started while their estimated decode memory fits in the budget (bytes)
+        self.workers = workers
+        self.memory_budget = memory_budget or default_memory_budget()
+        self.metrics = metrics or Metrics()
+
+    # worker processes only need the sizes, so don't ship the journal to them
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_journal'] = None
+        return state
 
     def thumbnail_many(self, params:list[ThumbnailParams]):
-        with Pool(12) as pool:
-            results = pool.map(self.thumbnail, params)
-        for result in results:
+        if self._journal:
+            params = [p for p in params if not self.is_journaled(p)]
+        for p, result in self.thumbnail_iter(params):
             if result:
                 print('Error: ', result)
+            else:
+                self.record(p)
+        if self.cache:
+            self.cache.evict()
+
+    def thumbnail_iter(self, params: list[ThumbnailParams]) -> Iterator[tuple[ThumbnailParams, Exception | None]]:
+        # smaller jobs may overtake one that does not fit, but only a bounded number of times
+        pending = self.jobs(params)
+        budget = MemoryBudget(self.memory_budget)
+        running = {}
+        overtaken = 0
+        with ProcessPoolExecutor(self.workers) as pool:
+            while pending or running:
+                i = 0
+                while i < len(pending) and len(running) < self.workers:
+                    job = pending[i]
+                    if budget.try_acquire(job.estimate):
+                        del pending[i]
+                        running[pool.submit(self.measured, job.method, job.argument)] = job
+                        overtaken = 0 if i == 0 else overtaken + 1
+                    elif i == 0 and overtaken >= 2 * self.workers:
+                        break
+                    else:
+                        i += 1
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    job = running.pop(future)
+                    budget.release(job.estimate)
+                    try:
+                        results, error, snapshot, seconds = future.result()
+                        self.metrics.merge(snapshot)
+                        self.completed(job, seconds)
+                    except Exception as e:
+                        results, error = None, e
+                    if error:
+                        results = [error] * len(job.params)
+                    elif not isinstance(results, list):
+                        results = [results]
+                    yield from zip(job.params, results)
+
+    def measured(self, method: str, argument) -> tuple[object, Exception | None, dict, float]:
+        start = time.perf_counter()
+        try:
+            result, error = getattr(self, method)(argument), None
+        except Exception as e:
+            result, error = None, e
+        return result, error, self.metrics.drain(), time.perf_counter() - start
+
+    def completed(self, job: ThumbnailJob, seconds: float):
+        pass
+
+    def jobs(self, params: list[ThumbnailParams]) -> list[ThumbnailJob]:
+        jobs = [ThumbnailJob([p], self.estimate_memory(p), 'thumbnail', p) for p in params if not p.ismovie]
+        movies = [p for p in params if p.ismovie]
+        for i in range(0, len(movies), self.video_batch_size):
+            batch = movies[i:i + self.video_batch_size]
+            estimate = sum(self.estimate_memory(p) for p in batch)
+            jobs.append(ThumbnailJob(batch, estimate, 'thumbnail_videos', [p.path for p in batch]))
+        return jobs
+
+    def estimate_memory(self, params: ThumbnailParams) -> int:
+        # from the header, without decoding
+        if params.ismovie:
+            return self.estimate_video_memory(params.path)
+        try:
+            with Image.open(params.path) as image:
+                width, height = image.size
+                bands = len(image.getbands())
+                format = image.format
+        except Exception:
+            # no readable header (e.g. RAW): assume ten times compression
+            return os.path.getsize(params.path) * 10 if os.path.exists(params.path) else 0
+        pixels = width * height
+        filename, ext = os.path.splitext(params.path)
+        skip_alt = ext == '.jpeg' or self.current_alternate(params.path, f"{filename}.jpeg")
+        if self.fast and format == 'JPEG' and skip_alt:
+            # draft decodes at the smallest power of two scale that still covers the largest size
+            scale = 1
+            while scale < 8 and min(width, height) // (scale * 2) >= self.sizes[0].max_size:
+                scale *= 2
+            pixels //= scale * scale
+        # the decoded image plus the copy made when transposing or resizing it
+        return pixels * bands * 2 + 32 * 1024 ** 2
+
+    def estimate_video_memory(self, path: str) -> int:
+        try:
+            output = subprocess.run(['ffprobe', '-v', 'error', '-select_streams', 'v:0',
+                                     '-show_entries', 'stream=width,height', '-of', 'csv=p=0', path],
+                                    capture_output=True, text=True, check=True).stdout
+            width, height = (int(v) for v in output.strip().split(',')[:2])
+        except Exception:
+            width, height = 3840, 2160
+        # decoder buffers for a handful of frames, the extracted frame and ffmpeg itself
+        return width * height * 3 * 8 + 128 * 1024 ** 2
+
+    def record(self, params: ThumbnailParams):
+        if self._journal and params.photo_uuid is not None:
+            outputs = self.output_paths(params)
+            self._journal.record(params.photo_uuid, params.game_id, Stage.THUMBNAILED, {os.path.basename(o): o for o in outputs})
+
+    def is_journaled(self, params: ThumbnailParams) -> bool:
+        if self._journal is None or params.photo_uuid is None or not self._journal.is_done(params.photo_uuid, params.game_id, Stage.THUMBNAILED):
+            return False
+        # the exported directory may have been cleaned up since
+        return all(os.path.exists(p) for p in self.output_paths(params))
+
+    def output_paths(self, params: ThumbnailParams) -> list[str]:
+        return list(self.outputs(params.path, params.ismovie).values())
+
+    def outputs(self, path: str, ismovie: bool) -> dict[str, str]:
+        # keyed by suffix relative to the source name
+        dir = os.path.dirname(path)
+        filename, ext = os.path.splitext(os.path.basename(path))
+        suffixes = []
+        if ismovie or ext != ALT_FORMAT.ext:
+            suffixes.append(ALT_FORMAT.ext)
+        for size in self.sizes:
+            for format in size.formats:
+                suffixes.append(f"_{size.name_modifier}{format.ext}")
+        return {suffix: os.path.join(dir, f"{filename}{suffix}") for suffix in suffixes}
+
+    def cache_settings(self, ismovie: bool) -> str:
+        # everything that changes the generated bytes has to be part of the cache key
+        sizes = ','.join(f'{size.name_modifier}:{size.max_size}:{"/".join(f.settings() for f in size.formats)}'
+                         for size in self.sizes)
+        return f'v3|movie={ismovie}|sizes={sizes}|fast={self.fast}|fast_resample={self.fast_resample_max_size}'
+
+    def cached(self, paths: list[str], ismovie: bool, render) -> list[Exception | None]:
+        if self.cache is None:
+            return render(paths)
+        results: dict[str, Exception | None] = {}
+        keys: dict[str, str] = {}
+        for path in paths:
+            try:
+                outputs = self.outputs(path, ismovie)
+                key = self.cache.key(path, self.cache_settings(ismovie))
+                if self.cache.restore(key, outputs):
+                    self.metrics.count('thumbnail', 'cache_hits')
+                    results[path] = None
+                    continue
+                self.metrics.count('thumbnail', 'cache_misses')
+                # outputs may be links into the cache, so never write through them
+                for suffix, output in outputs.items():
+                    if not os.path.exists(output):
+                        continue
+                    if suffix == ALT_FORMAT.ext and not ismovie:
+                        # kept for fast mode to reuse, as a copy of its own
+                        if os.stat(output).st_nlink > 1:
+                            shutil.copy2(output, f'{output}.tmp')
+                            os.replace(f'{output}.tmp', output)
+                    else:
+                        os.remove(output)
+                keys[path] = key
+            except Exception as e:
+                results[path] = e
+        misses = list(keys)
+        for path, error in zip(misses, render(misses) if misses else []):
+            results[path] = error
+            if error is None:
+                try:
+                    self.cache.store(keys[path], self.outputs(path, ismovie))
+                except Exception as e:
+                    results[path] = e
+        return [results[path] for path in paths]
 
     def thumbnail(self, params: ThumbnailParams):
         if params.ismovie:
@@ -37,33 +326,160 @@ class Thumbnailer:
             return self.thumbnail_photo(params.path)
 
     def thumbnail_photo(self, path: str):
+        with self.metrics.timer('thumbnail', 'photo'):
+            error = self.cached([path], False, lambda paths: [self.render_photo(p) for p in paths])[0]
+        self.count_results([path], [error])
+        return error
+
+    def count_results(self, paths: list[str], errors: list[Exception | None]):
+        for path, error in zip(paths, errors):
+            if error:
+                self.metrics.count('thumbnail', 'failures')
+            else:
+                self.metrics.count('thumbnail', 'thumbnailed')
+                self.metrics.count('thumbnail', 'bytes_read', os.path.getsize(path))
+
+    def render_photo(self, path: str):
         try:
             dir = os.path.dirname(path)
             filename, ext = os.path.splitext(os.path.basename(path))
-            image = Image.open(path)
-            ImageOps.exif_transpose(image, in_place=True)
-            alt_ext = '.jpeg'
-            if ext != alt_ext:
-                alt_name = os.path.join(dir, f"{filename}{alt_ext}")
-                image.save(alt_name)
-            for size in self.sizes:
-                image.thumbnail((size.max_size, size.max_size))
-                new_name = os.path.join(dir, f"{filename}_{size.name_modifier}{alt_ext}")
-                image.save(new_name)
+            alt_name = os.path.join(dir, f"{filename}.jpeg")
+            skip_alt = self.fast and self.current_alternate(path, alt_name)
+            for suffix, image, format in self.photo_images(path, skip_alt):
+                image.save(os.path.join(dir, f"{filename}{suffix}"), **format.save_options(image))
         except Exception as e:
             return e
+
+    def current_alternate(self, path: str, alt_name: str) -> bool:
+        # a photo re-exported after an edit is newer than the alternate made from the old one
+        return os.path.exists(alt_name) and os.path.getmtime(alt_name) >= os.path.getmtime(path)
+
+    def photo_images(self, path: str, skip_alt: bool = False) -> Iterator[tuple[str, Image.Image, ThumbnailFormat]]:
+        # the image is shrunk in place between yields, so save each one before moving on
+        _, ext = os.path.splitext(os.path.basename(path))
+        needs_alt = ext != ALT_FORMAT.ext and not skip_alt
+        image = Image.open(path)
+        if self.fast and not needs_alt:
+            image = self.reduced_decode(image)
+        ImageOps.exif_transpose(image, in_place=True)
+        if needs_alt:
+            yield ALT_FORMAT.ext, image, ALT_FORMAT
+        yield from self.sized_images(image)
+
+    def sized_images(self, image: Image.Image) -> Iterator[tuple[str, Image.Image, ThumbnailFormat]]:
+        for size in self.sizes:
+            image.thumbnail((size.max_size, size.max_size), resample=self.resample(size))
+            for format in size.formats:
+                yield f"_{size.name_modifier}{format.ext}", image, format
+
+    def reduced_decode(self, image: Image.Image) -> Image.Image:
+        # JPEGs are scaled by the decoder, other formats reduced by an integer factor
+        target = self.sizes[0].max_size
+        if image.format == 'JPEG':
+            image.draft('RGB', (target, target))
+            return image
+        # keep a factor of two in hand so the final resample still has detail to work with
+        factor = max(image.size) // (target * 2)
+        if factor > 1:
+            return image.reduce(factor)
+        return image
+
+    def resample(self, size: ThumbnailDef) -> Image.Resampling:
+        if self.fast and size.max_size <= self.fast_resample_max_size:
+            return Image.Resampling.BILINEAR
+        return Image.Resampling.BICUBIC
         
     def thumbnail_video(self, path:str):
+        return self.thumbnail_videos([path])[0]
+
+    def thumbnail_videos(self, paths: list[str]) -> list[Exception | None]:
+        with self.metrics.timer('thumbnail', 'videos'):
+            errors = self.cached(paths, True, self.render_videos)
+        self.count_results(paths, errors)
+        return errors
+
+    def render_videos(self, paths: list[str]) -> list[Exception | None]:
+        try:
+            frames = self.extract_frames(paths)
+        except Exception as e:
+            if len(paths) == 1:
+                return [e]
+            # one bad file fails the whole ffmpeg run, so retry each video on its own
+            self.metrics.count('thumbnail', 'batch_retries')
+            return [self.render_videos([path])[0] for path in paths]
+        return [self.save_video_thumbnails(path, frame) for path, frame in zip(paths, frames)]
+
+    def save_video_thumbnails(self, path: str, image: Image.Image):
         try:
             dir = os.path.dirname(path)
             filename, _ = os.path.splitext(os.path.basename(path))
-            ext = '.jpeg'
-            new_name = os.path.join(dir, f"{filename}{ext}")
-            subprocess.call(['ffmpeg', '-i', path, '-ss', '00:00:00.000', '-vframes', '1', new_name, '-y', '-hide_banner', '-loglevel', 'error'])
-            image = Image.open(new_name)
-            for size in self.sizes:
-                image.thumbnail((size.max_size, size.max_size))
-                new_name = os.path.join(dir, f"{filename}_{size.name_modifier}{ext}")
-                image.save(new_name)
+            for suffix, sized, format in self.video_images(image):
+                sized.save(os.path.join(dir, f"{filename}{suffix}"), **format.save_options(sized))
         except Exception as e:
-            return e        
\ No newline at end of file
+            return e
+
+    def video_images(self, frame: Image.Image) -> Iterator[tuple[str, Image.Image, ThumbnailFormat]]:
+        yield ALT_FORMAT.ext, frame, ALT_FORMAT
+        yield from self.sized_images(frame)
+
+    def thumbnail_to_memory(self, params: ThumbnailParams) -> dict[str, bytes]:
+        # raises on failure
+        filename, _ = os.path.splitext(os.path.basename(params.path))
+        with self.metrics.timer('thumbnail', 'to_memory'):
+            files = None
+            if self.cache:
+                key = self.cache.key(params.path, self.cache_settings(params.ismovie))
+                files = self.cache.load(key, list(self.outputs(params.path, params.ismovie)))
+                self.metrics.count('thumbnail', 'cache_hits' if files is not None else 'cache_misses')
+            if files is None:
+                files = self.render_to_memory(params)
+                self.metrics.count('thumbnail', 'bytes_encoded', sum(len(b) for b in files.values()))
+                if self.cache:
+                    self.cache.store_data(key, files)
+            buffers = {f"{filename}{suffix}": data for suffix, data in files.items()}
+        self.count_results([params.path], [None])
+        return buffers
+
+    def render_to_memory(self, params: ThumbnailParams) -> dict[str, bytes]:
+        if params.ismovie:
+            images = self.video_images(self.extract_frames([params.path])[0])
+        else:
+            images = self.photo_images(params.path)
+        files = dict()
+        for suffix, image, format in images:
+            buffer = io.BytesIO()
+            image.save(buffer, **format.save_options(image))
+            files[suffix] = buffer.getvalue()
+        return files
+
+    def extract_frames(self, paths: list[str]) -> list[Image.Image]:
+        # each frame goes to its own pipe as BMP, so nothing touches the disk
+        pipes = [os.pipe() for _ in paths]
+        args = ['ffmpeg', '-hide_banner', '-loglevel', 'error']
+        for path in paths:
+            args.extend(['-ss', '00:00:00.000', '-i', path])
+        for i, (_, write_fd) in enumerate(pipes):
+            args.extend(['-map', f'{i}:v:0', '-frames:v', '1', '-f', 'image2pipe', '-c:v', 'bmp', f'pipe:{write_fd}'])
+        try:
+            process = subprocess.Popen(args, stdin=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                                       pass_fds=[write_fd for _, write_fd in pipes])
+        except Exception:
+            for read_fd, _ in pipes:
+                os.close(read_fd)
+            raise
+        finally:
+            for _, write_fd in pipes:
+                os.close(write_fd)
+        # frames are larger than a pipe buffer, so every pipe has to be drained at once
+        with ThreadPoolExecutor(len(pipes) + 1) as executor:
+            errors = executor.submit(process.stderr.read)
+            frames = list(executor.map(self._read_pipe, [read_fd for read_fd, _ in pipes]))
+            stderr = errors.result()
+        process.stderr.close()
+        if process.wait() != 0 or not all(frames):
+            raise RuntimeError(f'ffmpeg failed for {paths}: {stderr.decode(errors="replace").strip()}')
+        return [Image.open(io.BytesIO(frame)) for frame in frames]
+
+    def _read_pipe(self, fd: int) -> bytes:
+        with os.fdopen(fd, 'rb') as pipe:
+            return pipe.read()